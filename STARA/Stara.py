@@ -12,11 +12,28 @@ import subprocess
 from datetime import datetime
 import shutil
 import argparse
+import io
+import gzip
+import json
+import sqlite3
+import hashlib
+import zlib
+import struct
+import time
+import resource
+import itertools
+from array import array
+from collections import Counter
+import heapq
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 #Default variables, they will all be set in the configuration file
 variables = dict()
 variables["FASTQC"] = "fastqc"
 variables["gzip"] = "gzip"
+variables["pigz"] = "pigz"
 variables["prinseq"] = "prinseq++"
 variables["flash"] = "flash"
 variables["maltrun"] = "malt-run"
@@ -29,16 +46,25 @@ variables["trimqual"] = 30
 variables["lefttrim"] = 20
 variables["maltsupp"] = 0.001
 variables["malteval"] = 0.001
+variables["maltminid"] = 75.0
+variables["malttop"] = 10.0
 variables["minmergedlength"] = 75
 variables["minoverlap"] = 1
 variables["maxoverlap"] = 500
 
 variables["keepraw"] = True
+#How raw files are kept in 00_RAW: auto (reflink or hardlink if possible, copy otherwise), reflink, hardlink, symlink or copy
+variables["ingest"] = "auto"
+variables["ingestthreads"] = 4
+#Record a checksum of every raw file in 00_RAW/CHECKSUMS.b2
+variables["checksums"] = False
 
 variables["paired"] = True
 variables["pairID1"] = ".1."
 variables["pairID2"] = ".2."
 variables["compressed"] = True
+#Feed raw reads to prinseq++ through pipes instead of decompressing them into a temp directory first
+variables["streaming"] = False
 
 #Allow to name the analysis (name of logfile, mainly)
 variables["name"] = "STARA"
@@ -49,7 +75,99 @@ variables["raw2filterloss"] = 0.7
 variables["filterabsolute"] = 4000
 variables["rawabsolute"] = 10000
 
+#Full FastQC reports are optional, the breakpoints use STARA's own read statistics
+variables["fastqcreports"] = False
+
+#Parallel execution: number of CPU-bound tools running at once and the total core budget shared by all tasks (0 = all usable cores)
+variables["jobs"] = 1
+variables["threads"] = 0
+#Samples aligned by one malt-run call, 0 aligns all samples that passed QC together, 1 aligns every sample on its own
+variables["maltbatch"] = 0
+#MALT runs that fit into memory at the same time
+variables["maltinstances"] = 1
+
+#Align only the unique filtered sequences, their abundance is passed to MALT as read magnitudes
+variables["dereplicate"] = True
+#Unique sequences counted in memory during dereplication, beyond that they are spread over partition files
+variables["derepmemory"] = 1000000
+
+#Cache of the best MALT hit of every unique sequence, shared by all analyses using the same file (empty = no cache)
+#Cached sequences are not aligned again, the least recently used hits beyond taxcachesize are evicted
+variables["taxcache"] = ""
+variables["taxcachesize"] = 5000000
+
+#Reference to taxon table (tab-separated) for the abundance matrix, without it the matrix rows are the MALT references
+variables["taxmap"] = ""
+
+#Directory for the intermediate files of the stages, e.g. on a local SSD or tmpfs (empty = in the output directory)
+variables["scratch"] = ""
+#What happens to the intermediate files of a stage once no other stage needs them: keep (moved to the output directory
+#if they are in the scratch directory), delete, or compress (into the output directory, with gzip or zstd at compresslevel)
+variables["retaintrim"] = "keep"
+variables["retainfilter"] = "keep"
+variables["retainderep"] = "keep"
+variables["compression"] = "gzip"
+variables["compresslevel"] = 1
+variables["scratchdir"] = ""
+
+#Watch mode: poll the input directory every watchinterval seconds and analyse samples as soon as their files are complete
+#A file is complete if it has a <file>.done marker or did not change for watchsettle seconds, watching ends with the
+#watchend file in the input directory or after watchtimeout seconds without a new sample (0 = no timeout)
+variables["watch"] = False
+variables["watchinterval"] = 30
+variables["watchsettle"] = 60
+variables["watchend"] = "STARA.done"
+variables["watchtimeout"] = 0
+
+#Worker mode: several STARA processes share the samples of one output directory through lease files in <outdir>/queue
+#A lease that was not renewed for leasetimeout seconds belongs to a dead worker and is taken over by another one
+#A worker claims workerclaim samples at once and aligns them together (0 = maltbatch samples, or 10 per job with maltbatch = 0)
+#Workers only use the sequence cache with taxcacheworkers = True, SQLite cannot lock a file on a network filesystem reliably
+variables["workerid"] = ""
+variables["leasetimeout"] = 300
+variables["workerclaim"] = 0
+variables["taxcacheworkers"] = False
+
+#Skip stages whose inputs and parameters did not change since the last run of this analysis
+variables["resume"] = True
+
+#Pre-flight triage: before any stage runs, the first triagereads reads of every sample are read to project its read count
+#(from the compressed file size) and the share of reads that survive trimming. Samples that miss rawabsolute or raw2trimloss
+#by more than triagemargin (relative to the threshold) are excluded, a read count known exactly has no margin
+variables["triage"] = True
+variables["triagereads"] = 10000
+variables["triagemargin"] = 0.25
+
+#Configuration values every stage depends on, a change invalidates the stage's checkpoint
+stagekeys = dict()
+stagekeys["rawqc"] = ["paired", "pairID1", "pairID2"]
+stagekeys["trim"] = ["prinseq", "paired", "pairID1", "pairID2", "compressed", "trimwindow", "trimqual", "lefttrim"]
+stagekeys["trimqc"] = ["paired", "pairID1", "pairID2"]
+stagekeys["filter"] = ["flash", "minoverlap", "maxoverlap", "minmergedlength"]
+stagekeys["derep"] = []
+stagekeys["align"] = ["maltrun", "maltbase", "maltsupp", "malteval", "maltminid", "malttop", "dereplicate", "taxcache"]
+stagekeys["aggregate"] = ["taxmap"]
+stagekeys["rawreport"] = ["FASTQC"]
+stagekeys["trimreport"] = ["FASTQC"]
+stagekeys["filterreport"] = ["FASTQC"]
+
+#Stages whose outputs are intermediate files, with a retention policy (retain<stage>)
+retainstages = ["trim", "filter", "derep"]
+
 global loghandle
+#Read files of every sample: raw files from setupFiles, stage outputs are added as the stages finish
+manifest = dict()
+#Sample and stage the running tools belong to, and the resources they used so far (see startTool and finishTool)
+currentstage = ("", "setup")
+stagetotals = dict()
+#Size and modification time of the input files at the last look in watch mode, and since when (by this host's clock) they are unchanged
+watched = dict()
+#Lease files held by this worker, they are renewed by the heartbeat thread
+leases = set()
+#Leases of this worker that another worker took over, the heartbeat thread moves them here from leases
+lostleases = set()
+#Modification time of the leases of other workers and when (by this host's clock) it was seen changing last
+leaseseen = dict()
 
 
 #read in config file
@@ -72,22 +190,130 @@ def readConfig(config):
         variables["keepraw"] = False
     else:
         variables["keepraw"] = True
+    if variables["checksums"] == "True":
+        variables["checksums"] = True
+    else:
+        variables["checksums"] = False
+    variables["ingestthreads"] = max(1, int(variables["ingestthreads"]))
+    if variables["compressed"] == "False":
+        variables["compressed"] = False
+    else:
+        variables["compressed"] = True
+    if variables["fastqcreports"] == "True":
+        variables["fastqcreports"] = True
+    else:
+        variables["fastqcreports"] = False
+    if variables["resume"] == "False":
+        variables["resume"] = False
+    else:
+        variables["resume"] = True
+    if variables["dereplicate"] == "False":
+        variables["dereplicate"] = False
+    else:
+        variables["dereplicate"] = True
+    if variables["watch"] == "True":
+        variables["watch"] = True
+    else:
+        variables["watch"] = False
+    variables["watchinterval"] = float(variables["watchinterval"])
+    variables["watchsettle"] = float(variables["watchsettle"])
+    variables["watchtimeout"] = float(variables["watchtimeout"])
+    variables["leasetimeout"] = float(variables["leasetimeout"])
+    variables["workerclaim"] = int(variables["workerclaim"])
+    if variables["taxcacheworkers"] == "True":
+        variables["taxcacheworkers"] = True
+    else:
+        variables["taxcacheworkers"] = False
+    variables["compresslevel"] = int(variables["compresslevel"])
+    if variables["triage"] == "False":
+        variables["triage"] = False
+    else:
+        variables["triage"] = True
+    variables["triagereads"] = max(1, int(variables["triagereads"]))
+    variables["triagemargin"] = float(variables["triagemargin"])
+    for stage in retainstages:
+        if not(variables["retain"+stage] in ["keep", "delete", "compress"]):
+            sys.stderr.write("[FATAL ERROR] retain"+stage+" has to be keep, delete or compress.")
+            sys.exit(1)
+    if variables["streaming"] == "True":
+        variables["streaming"] = True
+    else:
+        variables["streaming"] = False
     variables["rawabsolute"] = int(variables["rawabsolute"])
     variables["filterabsolute"] = int(variables["filterabsolute"])
     variables["raw2trimloss"] = float(variables["raw2trimloss"])
     variables["raw2filterloss"] = float(variables["raw2filterloss"])
     variables["trim2filterloss"] = float(variables["trim2filterloss"])
+    variables["jobs"] = int(variables["jobs"])
+    variables["threads"] = int(variables["threads"])
+    variables["maltbatch"] = int(variables["maltbatch"])
+    variables["maltinstances"] = max(1, int(variables["maltinstances"]))
+    variables["derepmemory"] = max(1, int(variables["derepmemory"]))
+    variables["minmergedlength"] = int(variables["minmergedlength"])
+    variables["maltsupp"] = float(variables["maltsupp"])
+    variables["malteval"] = float(variables["malteval"])
+    variables["maltminid"] = float(variables["maltminid"])
+    variables["malttop"] = float(variables["malttop"])
+    variables["taxcachesize"] = max(1, int(variables["taxcachesize"]))
+    if variables["taxcache"] != "":
+        variables["taxcache"] = os.path.abspath(os.path.expanduser(variables["taxcache"]))
     print(".")
 
 
+#Number of cores granted by a cgroup CPU quota (v2 or v1), None if there is no quota
+def cgroupCores():
+    quota = None
+    period = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as c:
+            split = c.read().split()
+            if split[0] != "max":
+                quota = int(split[0])
+                period = int(split[1])
+    except (IOError, OSError, IndexError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as c:
+                quota = int(c.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as c:
+                period = int(c.read())
+        except (IOError, OSError, ValueError):
+            return None
+    if quota is None or quota <= 0 or not period:
+        return None
+    return max(1, quota // period)
+
+
+#Number of cores this process may use, respecting CPU affinity and cgroup quotas
+def availableCores():
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = cgroupCores()
+    if quota is not None:
+        cores = min(cores, quota)
+    return cores
+
+
+#Split the global core budget across the CPU-bound tools running concurrently
+def setThreadBudget():
+    budget = variables["threads"]
+    if budget <= 0:
+        budget = availableCores()
+    variables["corebudget"] = budget
+    variables["jobs"] = max(1, min(variables["jobs"], budget))
+    variables["toolthreads"] = max(1, budget // variables["jobs"])
+
+
 #setup for files, if necessary moving input
 def setupFiles(indir, outdir):
     print("Setting up input"),
     if not os.path.exists(outdir):
         os.makedirs(outdir)
     global loghandle
-    loghandle = open(outdir+"/"+variables["name"]+".log", 'w')
+    loghandle = open(outdir+"/"+ownFile(".log"), 'a' if variables["resume"] else 'w')
     loghandle.write(str(datetime.now())+": Started Setup\n")
+    beginStage("", "setup")
     samples = list()
     os.chdir(outdir)
     if not os.path.exists(indir):
@@ -97,36 +323,253 @@ def setupFiles(indir, outdir):
     if not os.path.exists(os.getcwd()+"/"+rawdir):
         os.makedirs(os.getcwd()+"/"+rawdir)
     print("."),
-    for i in os.listdir(indir):
+    if variables["workerid"] != "":
+        samples = sharedSetup(indir)
+    else:
+        samples = findSamples(indir)
+    endStage()
+    print("."),
+    loghandle.write(str(datetime.now())+": Finished Setup successfully\n")
+    print(".")
+    return samples
+
+
+#Bring the raw files into 00_RAW and build the manifest, returns the samples whose read files are all there
+def findSamples(indir):
+    samples, incomplete = collectInput(indir)
+    #files moved into 00_RAW by an earlier run of this analysis
+    for i in sorted(os.listdir("00_RAW")):
+        if ((i.endswith("fastq.gz"))or (i.endswith("fq.gz"))):
+            sample = addRawFile(i)
+            if not(sample in samples):
+                samples.append(sample)
+    for sample in list(samples):
+        if None in manifest[sample]["raw"]:
+            #in watch mode the missing file may still be written
+            if not variables["watch"]:
+                loghandle.write("Sample "+sample+" is missing a read file and will not be analyzed\n")
+            samples.remove(sample)
+    writeManifest()
+    return triage(samples)
+
+
+#Setup in worker mode: the first worker takes the setup lease, brings the raw files into 00_RAW and writes the samples to the queue,
+#the other workers wait for queue/samples.json and read the samples and the manifest from there
+def sharedSetup(indir):
+    os.makedirs("queue/checkpoints", exist_ok=True)
+    #the setup lease is renewed while this worker sets up as well
+    threading.Thread(target=heartbeat, daemon=True).start()
+    while not os.path.exists("queue/samples.json"):
+        if takeLease("queue/setup"):
+            samples = findSamples(indir)
+            with open("queue/samples.json.tmp."+variables["workerid"], 'w') as out:
+                json.dump(dict(samples=samples, manifest=manifest), out)
+            os.replace("queue/samples.json.tmp."+variables["workerid"], "queue/samples.json")
+            releaseLease("queue/setup")
+        else:
+            time.sleep(leasePoll())
+    with open("queue/samples.json") as f:
+        queue = json.load(f)
+    manifest.update(queue["manifest"])
+    return queue["samples"]
+
+
+#Bring the complete raw files of the input directory into 00_RAW, files already there are skipped
+#Returns the samples of the complete files and the number of files that are still being written (watch mode only)
+def collectInput(indir):
+    samples = list()
+    toingest = list()
+    incomplete = 0
+    for i in sorted(os.listdir(indir)):
         if ((i.endswith("fastq.gz"))or (i.endswith("fq.gz"))):
             if not(i.startswith("\_")):
                 infile = indir+"/"+i
-                if variables["paired"]:
-                    if (re.search(variables["pairID1pattern"], i)):
-                        sample = re.split(variables["pairID1pattern"], i)[0]
-                    else:
-                        if (re.search(variables["pairID2pattern"], i)):
-                            sample = re.split(variables["pairID2pattern"], i)[0]
-                        else:
-                            raise ValueError("Read pair identifiers cannot be detected.")
-                else:
-                    sample = re.split('\.f[a-zA-Z]+q', i)[0]
+                outfile = "00_RAW/"+i
+                if not(os.path.exists(outfile)) and not(fileComplete(infile)):
+                    incomplete += 1
+                    continue
+                sample = addRawFile(i)
                 if not(sample in samples):
                     samples.append(sample)
-                    
-                outfile = "00_RAW/"+i
-                if variables["keepraw"]:
-                    command = subprocess.Popen(['cp', infile, outfile])
-                else:
-                    command = subprocess.Popen(['mv', infile, outfile])
-                command.wait()
+                if isCopied(infile, outfile):
+                    continue
+                toingest.append((infile, outfile))
         
         #else:
         #    raise ValueError("No valid compressed FastA files could be detected.")
-    print("."),
-    loghandle.write(str(datetime.now())+": Finished Setup successfully\n")
-    print(".")
-    return samples
+    ingestFiles(toingest)
+    return samples, incomplete
+
+
+#Check whether a raw file has been written completely: always outside of watch mode, otherwise if there is a
+#completion marker <file>.done next to it or if its size and modification time did not change for watchsettle seconds
+#Like the leases, only the looks at the file are timed, so the clocks of this host and the file server do not have to agree
+def fileComplete(path):
+    if not variables["watch"] or os.path.exists(path+".done"):
+        return True
+    info = os.stat(path)
+    observed = (info.st_size, info.st_mtime_ns)
+    now = time.time()
+    if not(path in watched) or watched[path][0] != observed:
+        watched[path] = (observed, now)
+    return now-watched[path][1] >= variables["watchsettle"]
+
+
+#Source of new samples for the scheduler in watch mode, samples already known are in started
+#Every call ingests the files that are complete by now and returns the samples that became complete, and whether watching is over:
+#once the end marker (watchend) is in the input directory and all files are ingested, or after watchtimeout seconds without a new sample
+def watchInput(indir, started):
+    last = [time.time()]
+    def source():
+        samples, incomplete = collectInput(indir)
+        new = [s for s in samples if not(s in started) and not(None in manifest[s]["raw"])]
+        started.update(new)
+        if len(new) > 0:
+            last[0] = time.time()
+            for s in new:
+                loghandle.write(str(datetime.now())+": Sample "+s+" was written completely and is added to the analysis\n")
+            writeManifest()
+            new = triage(new)
+        finished = incomplete == 0 and os.path.exists(indir+"/"+variables["watchend"])
+        if variables["watchtimeout"] > 0 and time.time()-last[0] > variables["watchtimeout"]:
+            loghandle.write(str(datetime.now())+": No new sample for "+str(variables["watchtimeout"])+" seconds, stopped watching "+indir+"\n")
+            finished = True
+        if finished:
+            for s in samples:
+                if not(s in started):
+                    loghandle.write("Sample "+s+" is missing a read file and will not be analyzed\n")
+        loghandle.flush()
+        return new, finished
+    return source
+
+
+#Pre-flight triage of the samples in parallel, returns the samples that are not excluded
+def triage(samples):
+    if not variables["triage"] or len(samples) == 0:
+        return samples
+    loghandle.write(str(datetime.now())+": Started pre-flight triage of "+str(len(samples))+" sample(s)\n")
+    loghandle.flush()
+    pool = ProcessPoolExecutor(max_workers=min(variables["corebudget"], len(samples)), initializer=initWorker, initargs=(dict(variables), os.getcwd()))
+    estimates = list(pool.map(triageSample, [manifest[s]["raw"] for s in samples]))
+    pool.shutdown()
+    kept = list()
+    for s, (reads, exact, retained) in zip(samples, estimates):
+        margin = 1.0 if exact else 1.0+variables["triagemargin"]
+        if reads*margin < variables["rawabsolute"]:
+            loghandle.write("Pre-flight: sample "+s+" is excluded with "+("a read count of only " if exact else "a projected read count of ")+str(reads)+"\n")
+        elif retained*(1.0+variables["triagemargin"]) < 1.0-variables["raw2trimloss"]:
+            loghandle.write("Pre-flight: sample "+s+" is excluded with an estimated loss of "+str(round(1.0-retained, 3))+" in trimming\n")
+        else:
+            kept.append(s)
+    loghandle.write(str(datetime.now())+": Finished pre-flight triage, "+str(len(samples)-len(kept))+" sample(s) excluded\n")
+    loghandle.flush()
+    return kept
+
+
+#Derive the sample identifier from the name of a raw read file
+def sampleName(filename):
+    if variables["paired"]:
+        if (re.search(variables["pairID1pattern"], filename)):
+            return re.split(variables["pairID1pattern"], filename)[0]
+        if (re.search(variables["pairID2pattern"], filename)):
+            return re.split(variables["pairID2pattern"], filename)[0]
+        raise ValueError("Read pair identifiers cannot be detected.")
+    return re.split('\.f[a-zA-Z]+q', filename)[0]
+
+
+#Add a raw file to the manifest of its sample, returns the sample
+def addRawFile(filename):
+    sample = sampleName(filename)
+    if not(sample in manifest):
+        manifest[sample] = dict(raw=[None, None] if variables["paired"] else [None])
+    index = 0
+    if variables["paired"] and not(re.search(variables["pairID1pattern"], filename)):
+        index = 1
+    manifest[sample]["raw"][index] = "00_RAW/"+filename
+    return sample
+
+
+#Name of a file of this STARA process in the output directory, workers write their own logfile and resource summary
+def ownFile(suffix):
+    if variables["workerid"] != "":
+        return variables["name"]+"."+variables["workerid"]+suffix
+    return variables["name"]+suffix
+
+
+#Keep the manifest of the analysis as JSON in the output directory
+def writeManifest():
+    with open(variables["name"]+".manifest.json", 'w') as out:
+        json.dump(manifest, out, indent=1, sort_keys=True)
+
+
+#Check whether a raw file was already copied to 00_RAW by an earlier run
+def isCopied(infile, outfile):
+    if not os.path.exists(outfile):
+        return False
+    source = os.stat(infile)
+    target = os.stat(outfile)
+    return source.st_size == target.st_size and int(source.st_mtime) == int(target.st_mtime)
+
+
+#Bring raw files into 00_RAW concurrently, optionally recording a checksum of every file
+def ingestFiles(toingest):
+    if len(toingest) == 0:
+        return
+    methods = Counter()
+    with ThreadPoolExecutor(max_workers=variables["ingestthreads"]) as ingest:
+        for method in ingest.map(lambda files: ingestFile(files[0], files[1]), toingest):
+            methods[method] += 1
+    loghandle.write("Ingested "+str(len(toingest))+" raw file(s): "+", ".join(m+" "+str(methods[m]) for m in sorted(methods))+"\n")
+    if variables["checksums"]:
+        with ThreadPoolExecutor(max_workers=variables["ingestthreads"]) as ingest:
+            digests = list(ingest.map(lambda outfile: fileDigest(outfile, ""), [outfile for infile, outfile in toingest]))
+        #b2sum -l 128 -c CHECKSUMS.b2 verifies these
+        with open("00_RAW/CHECKSUMS.b2", 'a') as out:
+            for (infile, outfile), digest in zip(toingest, digests):
+                out.write(digest+"  "+os.path.basename(outfile)+"\n")
+
+
+#Bring one raw file into 00_RAW, without copying its data where the filesystem allows it, returns the method used
+#ingest = auto tries a reflink (copy-on-write clone), then a hardlink, and falls back to copying
+def ingestFile(infile, outfile):
+    if os.path.lexists(outfile):
+        os.remove(outfile)
+    if not variables["keepraw"]:
+        shutil.move(infile, outfile)
+        return "move"
+    method = variables["ingest"]
+    samedevice = os.stat(infile).st_dev == os.stat(os.path.dirname(os.path.abspath(outfile))).st_dev
+    if method == "symlink":
+        os.symlink(os.path.abspath(infile), outfile)
+        return "symlink"
+    if method in ["auto", "reflink"] and samedevice and reflink(infile, outfile):
+        return "reflink"
+    if method in ["auto", "hardlink"] and samedevice:
+        try:
+            os.link(infile, outfile)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(infile, outfile)
+    return "copy"
+
+
+#Clone a file with the FICLONE ioctl (btrfs, XFS, ...), returns False if the filesystem does not support it
+def reflink(infile, outfile):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(infile, 'rb') as source:
+            with open(outfile, 'wb') as target:
+                fcntl.ioctl(target.fileno(), 0x40049409, source.fileno())
+        shutil.copystat(infile, outfile)
+        return True
+    except OSError:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        return False
 
 
 #print Identifiers of all detected samples to logfile
@@ -136,310 +579,1786 @@ def printSamples(samples):
         loghandle.write(s+"\n")
 
 
-#run FastQC on a given sample, either in paired or in single mode
+#Manifest entry holding the read files a QC mode looks at
+qcfiles = dict(raw="raw", trimmed="trim", filtered="filter")
+
+
+#run FastQC on the raw, trimmed or filtered reads of a sample
+#The breakpoints do not need the reports, so they are separate tasks that only run if requested
 def fastqc(samplename, indir, mode ):
-    file1 = ""
-    file2 = ""
     loghandle.write(str(datetime.now())+": Started QC\n")
-    if not os.path.exists(os.getcwd()+"/"+indir):
+    if not os.path.exists(os.path.join(os.getcwd(), indir)):
         sys.stderr.write("[FATAL ERROR] The directory on which you are running FastQC does not seem to exist. Please check file permissions and disk space.")
         sys.exit(1)
-    fastqcdir = indir+"/fastqc"
-    if not os.path.exists(os.getcwd()+"/"+fastqcdir):
-        os.makedirs(os.getcwd()+"/"+fastqcdir)
-    if mode=="paired":
+    fastqcdir = promotedPath(indir)+"/fastqc"
+    os.makedirs(os.path.join(os.getcwd(), fastqcdir), exist_ok=True)
+    files = manifest[samplename][qcfiles[mode]]
+    if len(files) == 2:
         loghandle.write("Entering paired filter mode\n")
-        for i in os.listdir(indir):
-            if i.startswith(samplename+variables["pairID1"]):
-                file1 = indir+"/"+i 
-            if i.startswith(samplename+variables["pairID2"]):
-                file2 = indir+"/"+i
-        command = subprocess.Popen([variables["FASTQC"], '-noextract','-o',fastqcdir,file1,file2])
-    else:
-        for i in os.listdir(indir):
-            if i.startswith(samplename):
-                file1 = indir+"/"+i 
-        command = subprocess.Popen([variables["FASTQC"],'-noextract','-o',fastqcdir,file1])
-    command.wait()
+    #reports are light tasks holding one core, reports of other samples run beside them
+    command = startTool([variables["FASTQC"],'-noextract','-t','1','-o',fastqcdir]+files)
+    finishTool(command)
     loghandle.write(str(datetime.now())+": Finished QC successfully\n")
 
+#Command decompressing a gzipped file to stdout with at most threads threads, pigz is preferred if it is installed
+def decompressCommand(infile, threads):
+    pigz = shutil.which(variables["pigz"])
+    if pigz is not None:
+        return [pigz, '-dc', '-p', str(threads), infile]
+    return [variables["gzip"], '-dc', infile]
+
+
+#Decompress (or copy) a raw file into a plain fastq file for prinseq++
+def materialise(infile, outfile):
+    if variables["compressed"]:
+        with open(outfile, 'w') as out:
+            command = startTool(decompressCommand(infile, variables["toolthreads"]), stdout=out)
+            finishTool(command)
+    else:
+        command = startTool(['cp', infile, outfile])
+        finishTool(command)
+
+
+#Path under which prinseq++ can read a raw file without a temporary copy, decompressing readers are added to readers
+#Every reader runs with a single thread next to prinseq++, which gets the other cores of the task (see threadsBeside)
+def streamInput(infile, readers):
+    if not variables["compressed"]:
+        return infile
+    reader = startTool(decompressCommand(infile, 1), stdout=subprocess.PIPE)
+    readers.append(reader)
+    return "/dev/fd/"+str(reader.stdout.fileno())
+
+
+#Threads for a tool running next to the decompression pipes, so that together they stay within the cores of the task
+def threadsBeside(readers):
+    return max(1, variables["toolthreads"]-len(readers))
+
+
+#Close our ends of the decompression pipes once the consumer holds them
+def closeReaders(readers):
+    for r in readers:
+        r.stdout.close()
+
+
+#Wait for the decompression pipes, they end once the consumer read all reads or exited
+def finishReaders(samplename, readers):
+    for r in readers:
+        if finishTool(r, check=False) != 0:
+            loghandle.write("Decompression of the raw reads for sample "+samplename+" ended with exit code "+str(r.returncode)+"\n")
+
+
 #Trim samples with prinseq++
 def trim(samplename, trimdir, rawdir):
     loghandle.write(str(datetime.now())+": Started trimming\n")
-    if not os.path.exists(os.getcwd()+"/"+trimdir):
-        os.makedirs(os.getcwd()+"/"+trimdir)
-    tempdir = trimdir+"/temp"
-    if not os.path.exists(os.getcwd()+"/"+tempdir):
-        os.makedirs(os.getcwd()+"/"+tempdir)
-    thedir = os.getcwd()+"/"+rawdir
+    os.makedirs(os.path.join(os.getcwd(), trimdir), exist_ok=True)
+    file1 = manifest[samplename]["raw"][0]
     if variables["paired"]:
-        for i in os.listdir(thedir):
-            temp = thedir+"/"+i
-            if os.path.isfile(temp):
-                if i.startswith(samplename+variables["pairID1"]):
-                    file1 = temp
-                if i.startswith(samplename+variables["pairID2"]):
-                    file2 = temp
-    else:
-        for i in os.listdir(thedir):
-            temp = thedir+"/"+i
-            if os.path.isfile(temp):
-                if i.startswith(samplename):
-                    file1 = temp
-    if variables["compressed"]:
-        outfile1 = open(tempdir+"/"+samplename+".fastq", 'w')
-        command = subprocess.Popen([variables["gzip"],'-dc', file1], stdout=outfile1)
-        #outfile1.writelines((command.stdout).read())
-        command.wait()
-        outfile1.close()
+        file2 = manifest[samplename]["raw"][1]
+    readers = list()
+    if variables["streaming"] and os.path.isdir("/dev/fd"):
+        #feed prinseq++ directly, compressed input is decompressed into pipes
+        tempdir = None
+        input1 = streamInput(file1, readers)
         if(variables["paired"]):
-            outfile1 = open(tempdir+"/"+samplename+variables["pairID1"]+".fastq", 'w')
-            command = subprocess.Popen([variables["gzip"],'-dc', file1], stdout=outfile1)
-            #outfile1.writelines((command.stdout).read())
-            command.wait()
-            outfile1.close()
-            outfile2 = open(tempdir+"/"+samplename+variables["pairID2"]+".fastq", 'w')
-            command = subprocess.Popen([variables["gzip"],'-dc', file2], stdout=outfile2)
-            #outfile2.writelines((command.stdout).read())
-            command.wait()
-            outfile2.close()
+            input2 = streamInput(file2, readers)
     else:
-        #copy original files to tempfile, temp directory will be deleted later
+        tempdir = trimdir+"/temp/"+samplename
+        os.makedirs(os.path.join(os.getcwd(), tempdir), exist_ok=True)
         if(variables["paired"]):
-            command = subprocess.Popen(['cp', file1, tempdir+"/"+samplename+variables["pairID1"]+".fastq"])
-            command = subprocess.Popen(['cp', file2, tempdir+"/"+samplename+variables["pairID2"]+".fastq"])
+            input1 = tempdir+"/"+samplename+variables["pairID1"]+".fastq"
+            input2 = tempdir+"/"+samplename+variables["pairID2"]+".fastq"
+            materialise(file1, input1)
+            materialise(file2, input2)
         else:
-            command = subprocess.Popen(['cp', file1, tempdir+"/"+samplename+".fastq"])
+            input1 = tempdir+"/"+samplename+".fastq"
+            materialise(file1, input1)
+    fds = [r.stdout.fileno() for r in readers]
     if(variables["paired"]):
 
-        command = subprocess.Popen([variables["prinseq"], '-fastq',tempdir+"/"+samplename+variables["pairID1"]+".fastq", '-fastq2',tempdir+"/"+samplename+variables["pairID2"]+".fastq", '-threads', '20', '-trim_qual_window',str(variables["trimwindow"]), '-trim_qual_right',str(variables["trimqual"]),
-                                   '-trim_left',str(variables["lefttrim"]), '-out_good',trimdir+"/"+samplename+".trim.good_1.fastq", '-out_good2',trimdir+"/"+samplename+".trim.good_2.fastq", '-out_bad',trimdir+"/"+samplename+".trim.bad"])
-        command.wait()
+        command = startTool([variables["prinseq"], '-fastq',input1, '-fastq2',input2, '-threads', str(threadsBeside(readers)), '-trim_qual_window',str(variables["trimwindow"]), '-trim_qual_type','min', '-trim_qual_right',str(variables["trimqual"]),
+                                   '-trim_left',str(variables["lefttrim"]), '-out_good',trimdir+"/"+samplename+".trim.good_1.fastq", '-out_good2',trimdir+"/"+samplename+".trim.good_2.fastq", '-out_bad',trimdir+"/"+samplename+".trim.bad"], pass_fds=fds)
+        closeReaders(readers)
+        finishReaders(samplename, readers)
+        finishTool(command)
         newname = samplename+".trimmed"+variables["pairID1"]+"fastq"
         outfile = trimdir+"/"+newname
         infile = trimdir+"/"+samplename+".trim.good_2.fastq"
-        command = subprocess.Popen(['mv',infile, outfile])
-        command.wait()
+        command = startTool(['mv',infile, outfile])
+        finishTool(command)
         newname = samplename+".trimmed"+variables["pairID2"]+"fastq"
         outfile = trimdir+"/"+newname
         infile = trimdir+"/"+samplename+".trim.good_1.fastq"
-        command = subprocess.Popen(['mv',infile, outfile])
-        command.wait()
+        command = startTool(['mv',infile, outfile])
+        finishTool(command)
     else:
-        command = subprocess.Popen([variables["prinseq"], '-fastq',tempdir+"/"+samplename+".fastq", '-threads', '20', '-trim_qual_window',str(variables["trimwindow"]), '-trim_qual_right',str(variables["trimqual"]),
-                                   '-trim_left', str(variables["lefttrim"]), '-out_good', trimdir+"/"+samplename+".trim.good", '-out_bad', trimdir+"/"+samplename+".trim.bad"])
-        command.wait()
+        command = startTool([variables["prinseq"], '-fastq',input1, '-threads', str(threadsBeside(readers)), '-trim_qual_window',str(variables["trimwindow"]), '-trim_qual_type','min', '-trim_qual_right',str(variables["trimqual"]),
+                                   '-trim_left', str(variables["lefttrim"]), '-out_good', trimdir+"/"+samplename+".trim.good", '-out_bad', trimdir+"/"+samplename+".trim.bad"], pass_fds=fds)
+        closeReaders(readers)
+        finishReaders(samplename, readers)
+        finishTool(command)
         newname = samplename+".trimmed.fastq"
         outfile = trimdir+"/"+newname
         infile = trimdir+"/"+samplename+".trim.good.fastq"
-        command = subprocess.Popen(['mv',infile, outfile])
-        command.wait()
-    
-    shutil.rmtree(os.getcwd()+"/"+tempdir)
+        command = startTool(['mv',infile, outfile])
+        finishTool(command)
+    if tempdir is not None:
+        shutil.rmtree(os.path.join(os.getcwd(), tempdir))
+        try:
+            os.rmdir(os.path.join(os.getcwd(), trimdir, "temp"))
+        except OSError:
+            pass
     loghandle.write(str(datetime.now())+": Finished trimming successfully\n")
 
-#Merge paired reads with FLASH  
-def merge(samplename, mergedir, trimdir):
-    loghandle.write(str(datetime.now())+": Started merging\n")
-    if not os.path.exists(os.getcwd()+"/"+trimdir):
-        sys.stderr.write("[FATAL ERROR] The directory you selected as holding trimmed reads does not seem to exist. Please check file permissions and disk space.")
-        sys.exit(1)
-    if not os.path.exists(os.getcwd()+"/"+mergedir):
-        os.makedirs(os.getcwd()+"/"+mergedir)
-    command = subprocess.Popen([variables["flash"], '-m', str(variables["minoverlap"]), '-M', str(variables["maxoverlap"]),'-o', mergedir+"/"+samplename, trimdir+"/"+samplename+".trimmed"+variables["pairID1"]+"fastq", trimdir+"/"+samplename+".trimmed"+variables["pairID2"]+"fastq"])
-    command.wait()
-    newname = samplename+".merged.fastq"
-    outfile = mergedir+"/"+newname
-    infile = mergedir+"/"+samplename+".extendedFrags.fastq"
-    command = subprocess.Popen(['mv',infile, outfile])
-    command.wait()
-    loghandle.write(str(datetime.now())+": Finished merging successfully\n")
-    
-  
-#Dilter for selected minimal sequence length with prinseq-lite 
-def filtering(samplename, filterdir, mergedir):
-    loghandle.write(str(datetime.now())+": Started filtering\n")
-    if not os.path.exists(os.getcwd()+"/"+filterdir):
-        os.makedirs(os.getcwd()+"/"+filterdir)
+#Merge paired reads with FLASH and filter for the minimal merged length in one streaming pass, single-end reads are only filtered
+#FLASH writes the merged reads to a pipe, the reads are handled in chunks and the statistics for the filtered QC are taken on the way
+def filtering(samplename, filterdir, mergedir, chunksize=20000):
+    loghandle.write(str(datetime.now())+": Started merging and filtering\n")
+    os.makedirs(os.path.join(os.getcwd(), filterdir), exist_ok=True)
+    command = None
     if(variables["paired"]):
-        command = subprocess.Popen([variables["prinseq"], '-fastq',mergedir+"/"+samplename+".merged.fastq", '-threads', '20',
-                                   '-min_len', str(variables["minmergedlength"]), '-out_good',filterdir+"/"+samplename+".filtered.good.fastq", '-out_bad',filterdir+"/bad_"+samplename+".filtered.bad"])
+        os.makedirs(os.path.join(os.getcwd(), mergedir), exist_ok=True)
+        command = startTool([variables["flash"], '-t', str(variables["toolthreads"]), '-m', str(variables["minoverlap"]), '-M', str(variables["maxoverlap"]), '-c', '-d', mergedir, '-o', samplename]+manifest[samplename]["trim"], stdout=subprocess.PIPE)
+        reads = command.stdout
     else:
-        command = subprocess.Popen([variables["prinseq"], '-fastq',mergedir+"/"+samplename+".trimmed.fastq",
-        '-threads', '20','-min_len', str(variables["minmergedlength"]), '-out_good',filterdir+"/"+samplename+".filtered.good.fastq", '-out_bad',filterdir+"/bad_"+samplename+".filtered.bad"])
-    command.wait()
-    loghandle.write(str(datetime.now())+": Finished filtering successfully\n")
+        reads = openReads(manifest[samplename]["trim"][0])
+    goodfile = filterdir+"/"+samplename+".filtered.good.fastq"
+    lengths = array('Q')
+    qualsums = array('Q')
+    count = 0
+    with reads, open(goodfile, 'wb') as good, open(filterdir+"/bad_"+samplename+".filtered.bad.fastq", 'wb') as bad:
+        while True:
+            chunk = list(itertools.islice(reads, 4*chunksize))
+            if len(chunk) == 0:
+                break
+            keep = list()
+            drop = list()
+            for i in range(0, len(chunk), 4):
+                if len(chunk[i+1].rstrip(b"\r\n")) >= variables["minmergedlength"]:
+                    keep.extend(chunk[i:i+4])
+                else:
+                    drop.extend(chunk[i:i+4])
+            good.writelines(keep)
+            bad.writelines(drop)
+            count += addStats([q.rstrip(b"\r\n") for q in keep[3::4]], lengths, qualsums)
+    if command is not None:
+        finishTool(command)
+    stats = summariseStats(count, lengths, qualsums)
+    writeStats(stats, filterdir+"/stats", os.path.basename(goodfile))
+    loghandle.write(str(datetime.now())+": Finished merging and filtering successfully\n")
+    return str(stats["minlength"]), str(stats["maxlength"]), str(stats["reads"])
+
+
+#Collapse identical filtered reads into unique sequences with their abundance, returns the read and unique sequence counts
+#Up to derepmemory unique sequences are counted in memory, after that all sequences go to partition files by sequence hash
+#and every partition is counted on its own, so memory stays bounded by the largest partition
+def dereplicate(samplename, filterdir, partitions=64):
+    loghandle.write(str(datetime.now())+": Started dereplication\n")
+    infile = manifest[samplename]["filter"][0]
+    counts = dict()
+    reads = 0
+    spilled = None
+    tempdir = filterdir+"/derep_"+samplename
+    with openReads(infile) as handle:
+        for line in itertools.islice(handle, 1, None, 4):
+            seq = line.rstrip(b"\r\n").upper()
+            reads += 1
+            if spilled is None:
+                counts[seq] = counts.get(seq, 0)+1
+                if len(counts) > variables["derepmemory"]:
+                    os.makedirs(tempdir, exist_ok=True)
+                    spilled = [open(tempdir+"/"+str(i)+".tsv", 'wb') for i in range(partitions)]
+                    for seen, count in counts.items():
+                        spilled[zlib.crc32(seen) % partitions].write(seen+b"\t"+str(count).encode()+b"\n")
+                    counts = dict()
+            else:
+                spilled[zlib.crc32(seq) % partitions].write(seq+b"\t1\n")
+    uniques = 0
+    with open(filterdir+"/"+samplename+".uniques.fasta", 'wb') as fasta, open(filterdir+"/"+samplename+".uniques.tsv", 'wb') as table:
+        if spilled is None:
+            uniques += writeUniques(counts, fasta, table)
+        else:
+            for part in spilled:
+                part.close()
+                counts = dict()
+                with open(part.name, 'rb') as f:
+                    for line in f:
+                        seq, count = line.rstrip(b"\n").split(b"\t")
+                        counts[seq] = counts.get(seq, 0)+int(count)
+                uniques += writeUniques(counts, fasta, table)
+            shutil.rmtree(tempdir)
+    loghandle.write("Dereplicated "+str(reads)+" reads of sample "+samplename+" into "+str(uniques)+" unique sequences\n")
+    loghandle.write(str(datetime.now())+": Finished dereplication successfully\n")
+    return reads, uniques
+
+
+#Write unique sequences, most abundant first, named by the hash of the sequence, with their abundance as weight for MALT and MEGAN
+def writeUniques(counts, fasta, table):
+    for seq, count in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
+        name = hashlib.blake2b(seq, digest_size=8).hexdigest().encode()
+        fasta.write(b">"+name+b" weight="+str(count).encode()+b"\n"+seq+b"\n")
+        table.write(name+b"\t"+str(count).encode()+b"\n")
+    return len(counts)
+
+
+#Reads MALT aligns for a sample, the unique sequences if dereplication is enabled
+def alignInput(samplename):
+    if variables["dereplicate"]:
+        return manifest[samplename]["derep"]
+    return manifest[samplename]["filter"]
 
 #Alignment and classification    
 def malt(samplename, aligneddir, filterdir):
-    loghandle.write(str(datetime.now())+": Started alignment\n")
-    if not os.path.exists(os.getcwd()+"/"+aligneddir):
-        os.makedirs(os.getcwd()+"/"+aligneddir)
-    infile = filterdir+"/"+samplename+".filtered.good.fastq"
-    outfile =aligneddir+"/"+samplename+".rma"
-    #I had to replace outfile with aligneddir, because MALT is broken
-    command = subprocess.Popen([variables["maltrun"], '-m', 'BlastN', '-at', 'SemiGlobal','-t','20','-rqc','true','-supp',str(variables["maltsupp"]),'-e', str(variables["malteval"]), '-mpi', str(75.0),'-top', str(10.0),'-i',infile,'-d',variables["maltbase"], '-o',aligneddir])
-    command.wait()
+    maltBatch([samplename], aligneddir, filterdir)
+
+
+#Align several samples with one malt-run call, so the MALT index is only loaded once
+#The best hit of every read (or unique sequence) is written to <sample>.assignments.tsv for the abundance matrix,
+#with a sequence cache only the unique sequences without a cached hit are aligned. The cache is opened and trimmed
+#to its size once per batch, the sequences are streamed from the files one sample at a time.
+def maltBatch(samples, aligneddir, filterdir):
+    cache = None
+    if variables["taxcache"] != "" and variables["dereplicate"]:
+        cache = openTaxCache()
+    try:
+        return maltRun(samples, aligneddir, cache)
+    finally:
+        if cache is not None:
+            cache[0].close()
+
+
+#Run MALT for a batch of samples and write their assignments, with the open sequence cache or None
+def maltRun(samples, aligneddir, cache):
+    loghandle.write(str(datetime.now())+": Started alignment of "+", ".join(samples)+"\n")
+    os.makedirs(os.path.join(os.getcwd(), aligneddir), exist_ok=True)
+    infiles = list()
+    for s in samples:
+        if cache is not None:
+            infiles.append(writeUnseen(s, cache, aligneddir+"/unseen"))
+        else:
+            infiles.append(alignInput(s)[0])
+    #unique sequences carry their abundance as magnitude, so MEGAN counts every read they stand for
+    magnitudes = ['-mag', 'true'] if variables["dereplicate"] else []
+    #the best hit of every aligned sequence is taken from MALT's SAM output
+    alignments = ['-a', aligneddir, '-f', 'SAM', '-za', 'false']
+    tomalt = [f for f in infiles if f is not None]
+    if len(tomalt) > 0:
+        #I had to replace outfile with aligneddir, because MALT is broken
+        #MALT names its output after the input files, they are renamed to <sample>.rma6 afterwards
+        command = startTool([variables["maltrun"], '-m', 'BlastN', '-at', 'SemiGlobal','-t',str(maltThreads()),'-rqc','true','-supp',str(variables["maltsupp"]),'-e', str(variables["malteval"]), '-mpi', str(variables["maltminid"]),'-top', str(variables["malttop"])]+magnitudes+alignments+['-i']+tomalt+['-d',variables["maltbase"], '-o',aligneddir])
+        finishTool(command)
+    aligned = list()
+    for s, infile in zip(samples, infiles):
+        #with the cache the alignment only holds the sequences that were not cached, it is named <sample>.uncached.rma6
+        target = aligneddir+"/"+s+(".uncached" if cache is not None else "")
+        if infile is not None:
+            base = aligneddir+"/"+re.sub('\.(f(ast)?q|fasta)(\.gz)?$', "", os.path.basename(infile))
+            if not os.path.exists(base+".rma6"):
+                loghandle.write("MALT did not write an alignment for sample "+s+"\n")
+                continue
+            if base != target:
+                os.replace(base+".rma6", target+".rma6")
+                if os.path.exists(base+".sam"):
+                    os.replace(base+".sam", target+".sam")
+            hits = samHits(target+".sam")
+            if cache is not None:
+                unseen = set(name for name, weight, seq in alignReads(infile))
+                os.remove(infile)
+                loghandle.write("The alignment of sample "+s+" in "+target+".rma6 only holds the unique sequences that were not in the cache\n")
+        else:
+            hits = dict()
+            unseen = set()
+            #an alignment of an earlier run would not match the assignments
+            for suffix in [".rma6", ".sam"]:
+                if os.path.exists(target+suffix):
+                    os.remove(target+suffix)
+            loghandle.write("No alignment was written for sample "+s+", all of its unique sequences were classified from the cache\n")
+        if cache is not None:
+            cached, total = cacheAssignments(alignInput(s)[0], cache, unseen, hits, aligneddir+"/"+s+".assignments.tsv")
+            loghandle.write(str(cached)+" of "+str(total)+" unique sequences of sample "+s+" were classified from the cache\n")
+        else:
+            streamAssignments(infile, hits, aligneddir+"/"+s+".assignments.tsv")
+        aligned.append(s)
+    if cache is not None:
+        evictHits(cache)
+    if cache is not None and os.path.isdir(aligneddir+"/unseen") and len(os.listdir(aligneddir+"/unseen")) == 0:
+        os.rmdir(aligneddir+"/unseen")
     loghandle.write(str(datetime.now())+": Finished alignment successfully\n")
-    
-#Read in output of FastQC for breakpoints    
+    return aligned
+
+
+#Name, abundance and sequence of the reads (or unique sequences) in a fastq or fasta file MALT aligns
+def alignReads(filename):
+    with openReads(filename) as reads:
+        for header in reads:
+            seq = next(reads).rstrip(b"\r\n")
+            if header.startswith(b"@"):
+                next(reads)
+                next(reads)
+            fields = header[1:].split()
+            weight = 1
+            for field in fields[1:]:
+                if field.startswith(b"weight="):
+                    weight = int(field[7:])
+            yield fields[0].decode(), weight, seq
+
+
+#Reads (or unique sequences with their abundance) of a file MALT aligns as (name, weight, sequence hash, sequence), count at a time
+def hashedReads(filename, count=10000):
+    chunk = list()
+    for name, weight, seq in alignReads(filename):
+        chunk.append((name, weight, hashlib.blake2b(seq, digest_size=16).hexdigest(), seq))
+        if len(chunk) >= count:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+
+#Cached best hits of sequence hashes as a dict hash -> hit, the hits found are marked as used
+def lookupCache(cache, hashes):
+    db, database, params = cache
+    hits = dict()
+    now = time.time()
+    with db:
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i+500]
+            hits.update(db.execute("SELECT sequence, hit FROM hits WHERE db = ? AND params = ? AND sequence IN ("+",".join("?"*len(chunk))+")", [database, params]+chunk).fetchall())
+        db.executemany("UPDATE hits SET used = ? WHERE db = ? AND params = ? AND sequence = ?", [(now, database, params, h) for h in hits])
+    return hits
+
+
+#Write the unique sequences of a sample without a cached hit for MALT, returns the file or None if all sequences were cached
+def writeUnseen(samplename, cache, unseendir):
+    os.makedirs(unseendir, exist_ok=True)
+    fastafile = unseendir+"/"+samplename+".fasta"
+    unseen = 0
+    with open(fastafile, 'wb') as fasta:
+        for chunk in hashedReads(alignInput(samplename)[0]):
+            hits = lookupCache(cache, [r[2] for r in chunk])
+            for name, weight, digest, seq in chunk:
+                if not(digest in hits):
+                    fasta.write(b">"+name.encode()+b" weight="+str(weight).encode()+b"\n"+seq+b"\n")
+                    unseen += 1
+    if unseen == 0:
+        os.remove(fastafile)
+        return None
+    return fastafile
+
+
+#Best hit of every aligned sequence from MALT's SAM output (the first alignment of a query), * if it was not aligned
+def samHits(samfile):
+    hits = dict()
+    if os.path.exists(samfile):
+        with open(samfile) as sam:
+            for line in sam:
+                if line.startswith("@"):
+                    continue
+                fields = line.split("\t")
+                if fields[0] not in hits:
+                    hits[fields[0]] = "*" if int(fields[1]) & 4 else fields[2]
+    return hits
+
+
+#Open the sequence cache, the hits of an earlier version of the MALT database are dropped
+#Returns the connection and the keys of this analysis: the database identity and the alignment parameters
+def openTaxCache():
+    os.makedirs(os.path.dirname(variables["taxcache"]), exist_ok=True)
+    db = sqlite3.connect(variables["taxcache"], timeout=600)
+    db.execute("CREATE TABLE IF NOT EXISTS hits (sequence TEXT, db TEXT, params TEXT, hit TEXT, used REAL, PRIMARY KEY (sequence, db, params))")
+    db.execute("CREATE INDEX IF NOT EXISTS hitsused ON hits (used)")
+    db.execute("CREATE TABLE IF NOT EXISTS databases (path TEXT PRIMARY KEY, identity TEXT)")
+    path = os.path.abspath(variables["maltbase"])
+    database = databaseIdentity()
+    params = json.dumps([variables["maltsupp"], variables["malteval"], variables["maltminid"], variables["malttop"]])
+    with db:
+        row = db.execute("SELECT identity FROM databases WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] != database:
+            db.execute("DELETE FROM hits WHERE db = ?", (row[0],))
+        db.execute("INSERT OR REPLACE INTO databases VALUES (?, ?)", (path, database))
+    return db, database, params
+
+
+#Evict the least recently used hits beyond taxcachesize from the cache
+def evictHits(cache):
+    db = cache[0]
+    with db:
+        excess = db.execute("SELECT COUNT(*) FROM hits").fetchone()[0]-variables["taxcachesize"]
+        if excess > 0:
+            db.execute("DELETE FROM hits WHERE rowid IN (SELECT rowid FROM hits ORDER BY used LIMIT ?)", (excess,))
+
+
+#Best hit and abundance of every read (or unique sequence) of a sample streamed from the reads MALT aligned,
+#sequences without a hit are written with *
+def streamAssignments(infile, hits, outfile):
+    with open(outfile, 'w') as out:
+        out.write("sequence\tweight\thit\tsource\n")
+        for name, weight, seq in alignReads(infile):
+            out.write(name+"\t"+str(weight)+"\t"+hits.get(name, "*")+"\tmalt\n")
+
+
+#Best hit and abundance of every unique sequence of a sample, and whether it came from the cache or from MALT's hits,
+#the hits of the unseen sequences MALT aligned are added to the cache. The unique sequences are read again, the cached ones
+#were just marked as used by writeUnseen. Returns the number of unique sequences classified from the cache and of all unique sequences.
+def cacheAssignments(infile, cache, unseen, hits, outfile):
+    db, database, params = cache
+    cached = 0
+    total = 0
+    with open(outfile, 'w') as out:
+        out.write("sequence\tweight\thit\tsource\n")
+        for chunk in hashedReads(infile):
+            found = lookupCache(cache, [r[2] for r in chunk if not(r[0] in unseen)])
+            now = time.time()
+            new = list()
+            for name, weight, digest, seq in chunk:
+                if digest in found:
+                    out.write(name+"\t"+str(weight)+"\t"+found[digest]+"\tcache\n")
+                    cached += 1
+                else:
+                    out.write(name+"\t"+str(weight)+"\t"+hits.get(name, "*")+"\tmalt\n")
+                    new.append((digest, database, params, hits.get(name, "*"), now))
+            with db:
+                db.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?)", new)
+            total += len(chunk)
+    return cached, total
+
+
+#Threads for a MALT run, a single batch of all samples runs after all other stages and gets the whole core budget
+def maltThreads():
+    if variables["maltbatch"] == 0:
+        return variables["corebudget"]
+    return variables["toolthreads"]
+
+
+#Align all samples that passed the filtered QC, maltbatch samples per malt-run call (0 = all in one call), returns the aligned samples
+#Samples whose alignment is still current according to the checkpoint manifest are not aligned again
+def alignSamples(samples, aligneddir, filterdir):
+    fingerprints = dict()
+    pending = list()
+    aligned = list()
+    for s in samples:
+        fingerprints[s] = stageFingerprint(s, "align", alignInput(s))
+        current, result, outputs = stageCurrent(s, "align", fingerprints[s])
+        if current:
+            aligned.append(s)
+            loghandle.write(str(datetime.now())+": Finished analysis for sample "+s+" successfully\n")
+        else:
+            pending.append(s)
+    size = variables["maltbatch"]
+    if size <= 0:
+        size = max(1, len(pending))
+    for i in range(0, len(pending), size):
+        beginStage(",".join(pending[i:i+size]), "align")
+        batch = maltBatch(pending[i:i+size], aligneddir, filterdir)
+        endStage()
+        for s in batch:
+            recordStage(s, "align", fingerprints[s], stageOutputs(s, "align"))
+            aligned.append(s)
+            loghandle.write(str(datetime.now())+": Finished analysis for sample "+s+" successfully\n")
+        loghandle.flush()
+    return aligned
+
+
+#Read statistics of a sample for the breakpoints
 def readQC(samplename, indi ,mode):
-    indir = os.getcwd()+"/"+indi
     pair = True
-    file1 = ""
-    file2 = ""
     #set pair according to mode and "paired"/not
     #modes are raw, trimmed, filtered (filtered is always not a paired mode)
     if (mode=="filtered"):
         pair = False
     else:
         pair = variables["paired"]
-        
+    files = manifest[samplename][qcfiles[mode]]
+    #paired breakpoints are based on R2
     if pair:
-        short1 = variables["pairID1"][:-1]
-        print(short1)
-        short2 = variables["pairID2"][:-1]
-        for i in os.listdir(indir+"/fastqc/"):
-            print(i)
-            if (i.startswith(samplename+short1) and i.endswith('zip')):
-                file1 = indir+"/fastqc/"+i 
-            if (i.startswith(samplename+short2) and i.endswith('zip')):
-                file2 = indir+"/fastqc/"+i 
-        command = subprocess.Popen(['unzip','-o','-d',indir+"/fastqc",file1])
-        command.wait()
-        command = subprocess.Popen(['unzip','-o','-d',indir+"/fastqc",file2])
-        command.wait()
-        print(file1)
-        sub1 = re.sub("\.zip","", file1)
-        print(sub1)
-        filename1 = sub1+"/fastqc_data.txt"
-        sub2 = re.sub("\.zip","", file2)
-        filename2 = sub2+"/fastqc_data.txt"
-        tuple1 = fastqcData(filename1)
-        tuple2 = fastqcData(filename2)
-        
-        #for now, return tuple2
-        return tuple2
+        filename = files[1]
     else:
-        for i in os.listdir(indir+"/fastqc/"):
-            if (i.startswith(samplename) and i.endswith('zip')):
-                file1 = indir+"/fastqc/"+i 
-        command = subprocess.Popen(['unzip','-o','-d',indir+"/fastqc",file1])
-        command.wait()
-        sub = re.sub("\.zip","", file1)
-        filename1 = sub+"/fastqc_data.txt"
-        tuple1 = fastqcData(filename1)
-        return tuple1
-       
-        
-#Read in FastQC file        
-def fastqcData(qcdata):
-    mini = 0
-    maxi = 0
-    num = 0
-    with open(qcdata) as qc:
-        for line in qc:
-            line = re.sub('\n', "", line)
-            #number of sequences
-            if (line.startswith("Total Sequences")):
-                s = re.split('\t', line)
-                num = s[-1]
-            #min/max length
-            if (line.startswith("Sequence length")):
-                s = re.split('\t', line)
-                tmp = s[-1]
-                if re.search("-", tmp):
-                    split = re.split("-", tmp)
-                    mini = split[0]
-                    maxi = split[1]
-                else:
-                    mini = tmp
-                    maxi = tmp
-    
-    result = mini, maxi, num
+        filename = files[0]
+    stats = fastqStats(filename)
+    writeStats(stats, indi+"/stats", os.path.basename(filename))
+    result = str(stats["minlength"]), str(stats["maxlength"]), str(stats["reads"])
     return result
-    
-#run the full analysis pipeline  
-def runAnalysis(indir, outdir,config):
-    readConfig(config)
-    samples = setupFiles(indir, outdir)
-    printSamples(samples)
-    loghandle.write("Configuration for this analysis is read from: "+str(config)+"\n")
-    for s in samples:
-    
-        loghandle.write(str(datetime.now())+": Running analysis for sample "+s+"\n")
-        if(variables["paired"] == True):
-            fastqc(s, "00_RAW", "paired")
-            t1 = readQC(s, "00_RAW", "raw")
-            if int(t1[2])< variables["rawabsolute"]:
-                loghandle.write("Breakpoint: Raw QC for sample "+s+" failed with a read count of only "+t1[2]+"\n")
-                continue
-            loghandle.write("Raw QC for sample: "+s+" (based on R2)\n")
-            loghandle.write("Minimal read length: "+t1[0]+", maximal read length: "+t1[1]+", number of reads: "+t1[2]+"\n")
-            trim(s, "01_trimmed", "00_RAW")
-            fastqc(s+".trimmed", "01_trimmed", "paired")
-            t2 = readQC(s+".trimmed", "01_trimmed", "trimmed")
-            raw2trimloss = 1.0-(float(t2[2])/float(t1[2]))
-            if raw2trimloss > variables["raw2trimloss"]:
-                loghandle.write("Breakpoint: Trimmed QC for sample "+s+" failed with a loss of "+str(raw2trimloss)+" compared to raw read counts\n")
-                continue
-            loghandle.write("Trimmed QC for sample: "+s+" (based on R2) \n")
-            loghandle.write("Minimal read length: "+t2[0]+", maximal read length: "+t2[1]+", number of reads: "+t2[2]+"\n")
-            merge(s,"02_merged", "01_trimmed" )
-            filtering(s, "03_filtered", "02_merged")
-            fastqc(s+".filtered", "03_filtered", "single")
-            t3 = readQC(s+".filtered", "03_filtered", "filtered")
-            if int(t3[2])< variables["filterabsolute"]:
-                loghandle.write("Breakpoint: Filtered QC for sample "+s+" failed with a read count of only "+t3[2]+"\n")
+
+
+#Estimates of the pre-flight triage for the raw files of a sample, in a pool worker:
+#the (projected) read count based on R2, whether it is exact, and the share of reads (pairs) that survive trimming
+def triageSample(files):
+    prefixes = [samplePrefix(f, variables["triagereads"]) for f in files]
+    quals, reads, exact = prefixes[-1]
+    pairs = list(zip(*[p[0] for p in prefixes]))
+    if len(pairs) == 0:
+        return reads, exact, 0.0
+    retained = sum(1 for pair in pairs if all(trimSurvives(q) for q in pair))
+    return reads, exact, float(retained)/len(pairs)
+
+
+#Quality strings of the first count reads of a plain or gzipped fastq file and the projected number of reads in the file
+#The projection scales the reads of the prefix by the file size over the compressed bytes read, the count is exact if the whole file was read
+def samplePrefix(filename, count, blocksize=65536):
+    size = os.path.getsize(filename)
+    data = bytearray()
+    consumed = 0
+    newlines = 0
+    with open(filename, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+        f.seek(0)
+        decompressor = zlib.decompressobj(31)
+        while newlines <= 4*count:
+            block = f.read(blocksize)
+            if len(block) == 0:
+                break
+            consumed += len(block)
+            if gzipped:
+                block = decompressor.decompress(block)
+                #concatenated gzip members
+                while decompressor.eof and len(decompressor.unused_data) > 0:
+                    rest = decompressor.unused_data
+                    decompressor = zlib.decompressobj(31)
+                    block += decompressor.decompress(rest)
+            data += block
+            newlines += block.count(b"\n")
+    lines = bytes(data).split(b"\n")
+    complete = consumed == size
+    if complete and lines[-1] == b"":
+        lines.pop()
+    records = min(count, len(lines)//4)
+    quals = [q.rstrip(b"\r") for q in lines[3:4*records:4]]
+    if complete and records == len(lines)//4:
+        return quals, records, True
+    used = sum(len(l)+1 for l in lines[:4*records])
+    return quals, int(records*float(size)/consumed*len(data)/used), False
+
+
+#Whether any of a read is left after trimming with the trimming parameters (left trim, then quality trim from the right)
+#The quality trim (-trim_qual_type min) keeps the read up to the last window whose lowest quality reaches trimqual,
+#so a read survives if it has trimwindow bases in a row of at least trimqual, or if all bases up to one of them do (shorter windows at the start)
+def trimSurvives(qual):
+    qual = qual[int(variables["lefttrim"]):]
+    window = int(variables["trimwindow"])
+    threshold = int(variables["trimqual"])+33
+    run = 0
+    for i, q in enumerate(qual):
+        run = run+1 if q >= threshold else 0
+        if run >= window or run == i+1:
+            return True
+    return False
+
+
+#Open a plain or gzipped read file for reading bytes
+def openReads(filename):
+    with open(filename, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+#Read count, length histogram and mean quality per position of a plain or gzipped fastq file in one streaming pass
+def fastqStats(filename, chunksize=20000):
+    lengths = array('Q')
+    qualsums = array('Q')
+    reads = 0
+    with openReads(filename) as handle:
+        while True:
+            chunk = list(itertools.islice(handle, 4*chunksize))
+            if len(chunk) == 0:
+                break
+            reads += addStats([q.rstrip(b"\r\n") for q in chunk[3::4]], lengths, qualsums)
+    return summariseStats(reads, lengths, qualsums)
+
+
+#Add a chunk of quality strings to the length histogram and the per-position quality sums, returns the number of reads
+#Per-position quality sums are taken column-wise over the whole chunk
+def addStats(quals, lengths, qualsums):
+    for length, count in Counter(map(len, quals)).items():
+        if length >= len(lengths):
+            lengths.extend([0]*(length+1-len(lengths)))
+        lengths[length] += count
+    sums = [sum(column) for column in itertools.zip_longest(*quals, fillvalue=0)]
+    if len(sums) > len(qualsums):
+        qualsums.extend([0]*(len(sums)-len(qualsums)))
+    for pos in range(len(sums)):
+        qualsums[pos] += sums[pos]
+    return len(quals)
+
+
+#Read statistics from the length histogram and the per-position quality sums
+def summariseStats(reads, lengths, qualsums):
+    #reads covering a (0-based) position are all reads longer than it
+    meanquality = list()
+    covering = reads
+    for pos in range(len(qualsums)):
+        covering -= lengths[pos]
+        if covering > 0:
+            meanquality.append(round(float(qualsums[pos])/covering-33, 2))
+    observed = [l for l in range(len(lengths)) if lengths[l] > 0]
+    stats = dict()
+    stats["reads"] = reads
+    stats["minlength"] = observed[0] if observed else 0
+    stats["maxlength"] = observed[-1] if observed else 0
+    stats["lengths"] = dict((l, lengths[l]) for l in observed)
+    stats["meanquality"] = meanquality
+    return stats
+
+
+#Keep the statistics of a read file next to the stage output
+def writeStats(stats, statsdir, name):
+    statsdir = promotedPath(statsdir)
+    os.makedirs(statsdir, exist_ok=True)
+    with open(statsdir+"/"+re.sub('\.f(ast)?q(\.gz)?$', "", name)+".stats.json", 'w') as out:
+        json.dump(stats, out)
+
+
+#Start an external tool, its resource usage is recorded by finishTool
+def startTool(args, **kwargs):
+    command = subprocess.Popen(args, **kwargs)
+    command.started = time.time()
+    command.tool = os.path.basename(args[0])
+    command.stage = currentstage
+    return command
+
+
+#Bytes read and written by a finished (not yet reaped) process and its reaped children, None where /proc is not available
+def processIO(pid):
+    try:
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        counters = dict()
+        with open("/proc/"+str(pid)+"/io") as f:
+            for line in f:
+                split = line.split(":")
+                counters[split[0]] = int(split[1])
+        return counters["rchar"], counters["wchar"]
+    except (AttributeError, OSError, KeyError, ValueError):
+        return None
+
+
+#Wait for an external tool and record its wall time, CPU time, peak RSS and I/O in the metrics file
+#A non-zero exit code raises an OSError unless check is False, so the stage fails before it is recorded as finished
+def finishTool(command, check=True):
+    if command.returncode is not None:
+        return command.returncode
+    counters = processIO(command.pid)
+    pid, status, usage = os.wait4(command.pid, 0)
+    command.returncode = os.waitstatus_to_exitcode(status)
+    metrics = dict()
+    metrics["sample"] = command.stage[0]
+    metrics["stage"] = command.stage[1]
+    metrics["tool"] = command.tool
+    metrics["wall"] = round(time.time()-command.started, 3)
+    metrics["cpu"] = round(usage.ru_utime+usage.ru_stime, 3)
+    metrics["maxrss"] = maxrssBytes(usage)
+    if counters is not None:
+        metrics["readbytes"], metrics["writtenbytes"] = counters
+    else:
+        metrics["readbytes"] = usage.ru_inblock*512
+        metrics["writtenbytes"] = usage.ru_oublock*512
+    metrics["exitcode"] = command.returncode
+    writeMetrics("tool", metrics)
+    if command.stage == currentstage:
+        stagetotals["cpu"] = stagetotals.get("cpu", 0.0)+metrics["cpu"]
+        stagetotals["maxrss"] = max(stagetotals.get("maxrss", 0), metrics["maxrss"])
+        stagetotals["readbytes"] = stagetotals.get("readbytes", 0)+metrics["readbytes"]
+        stagetotals["writtenbytes"] = stagetotals.get("writtenbytes", 0)+metrics["writtenbytes"]
+    if check and command.returncode != 0:
+        raise OSError(command.tool+" failed with exit code "+str(command.returncode))
+    return command.returncode
+
+
+#Peak resident set size in bytes, Linux reports kilobytes
+def maxrssBytes(usage):
+    if sys.platform == "darwin":
+        return usage.ru_maxrss
+    return usage.ru_maxrss*1024
+
+
+#Append one record to the metrics file of the analysis (of the worker in worker mode), one JSON object per line
+def writeMetrics(kind, metrics):
+    metrics["kind"] = kind
+    metrics["run"] = variables["runid"]
+    with open(ownFile(".metrics.jsonl"), 'a') as out:
+        out.write(json.dumps(metrics, sort_keys=True)+"\n")
+
+
+#Start measuring a stage of a sample (or of a batch of samples), tools started from now on are counted for it
+def beginStage(sample, stage):
+    global currentstage
+    currentstage = (sample, stage)
+    stagetotals.clear()
+    stagetotals["started"] = time.time()
+    stagetotals["self"] = resource.getrusage(resource.RUSAGE_SELF)
+    stagetotals["peakreset"] = resetPeakRSS()
+
+
+#Reset the peak RSS of this process to its current RSS (Linux), returns False where this is not possible
+def resetPeakRSS():
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+#Peak RSS of this process in bytes since the last reset
+def peakRSS():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])*1024
+    return 0
+
+
+#Record the resources of the stage started by beginStage, including the work done inside STARA itself
+#The peak RSS of a stage is the largest of its tools' and of this process during the stage (which includes what the process held
+#before), the latter only where the peak can be reset at the start of the stage
+def endStage():
+    global currentstage
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    metrics = dict()
+    metrics["sample"] = currentstage[0]
+    metrics["stage"] = currentstage[1]
+    metrics["wall"] = round(time.time()-stagetotals["started"], 3)
+    metrics["cpu"] = round(stagetotals.get("cpu", 0.0)+usage.ru_utime+usage.ru_stime-stagetotals["self"].ru_utime-stagetotals["self"].ru_stime, 3)
+    metrics["maxrss"] = max(stagetotals.get("maxrss", 0), peakRSS() if stagetotals["peakreset"] else 0)
+    metrics["readbytes"] = stagetotals.get("readbytes", 0)
+    metrics["writtenbytes"] = stagetotals.get("writtenbytes", 0)
+    writeMetrics("stage", metrics)
+    currentstage = (currentstage[0], "")
+
+
+#Record how many reads went into and came out of a stage
+def recordReads(sample, stage, readsin, readsout):
+    metrics = dict()
+    metrics["sample"] = sample
+    metrics["stage"] = stage
+    metrics["readsin"] = int(readsin)
+    metrics["readsout"] = int(readsout)
+    writeMetrics("reads", metrics)
+
+
+#Summarise the metrics of this run per stage and per tool, as metrics table and in the logfile
+def summariseMetrics():
+    if not os.path.exists(ownFile(".metrics.jsonl")):
+        return
+    summary = dict()
+    with open(ownFile(".metrics.jsonl")) as f:
+        for line in f:
+            try:
+                metrics = json.loads(line)
+            except ValueError:
+                #a record cut off by an interrupted run
                 continue
-            raw2filterloss = 1.0-(float(t3[2])/float(t1[2]))
-            if raw2filterloss > variables["raw2filterloss"]:
-                loghandle.write("Breakpoint: Filtered QC for sample "+s+" failed with a loss of "+str(raw2filterloss)+" compared to raw read counts\n")
+            if metrics["run"] != variables["runid"]:
                 continue
-            trim2filterloss = 1.0-(float(t3[2])/float(t2[2]))
-            if trim2filterloss > variables["trim2filterloss"]:
-                loghandle.write("Breakpoint: Filtered QC for sample "+s+" failed with a loss of "+str(trim2filterloss)+" compared to trimmed read counts\n")
+            if metrics["kind"] == "tool":
+                key = ("tool", metrics["tool"])
+            else:
+                key = ("stage", metrics["stage"])
+            if not(key in summary):
+                summary[key] = dict(count=0, wall=0.0, maxwall=0.0, cpu=0.0, maxrss=0, readbytes=0, writtenbytes=0, readsin=0, readsout=0)
+            entry = summary[key]
+            if metrics["kind"] == "reads":
+                entry["readsin"] += metrics["readsin"]
+                entry["readsout"] += metrics["readsout"]
                 continue
-            loghandle.write("Filtered QC for sample: "+s+"\n")
-            loghandle.write("Minimal read length: "+t3[0]+", maximal read length: "+t3[1]+", number of reads: "+t3[2]+"\n")
-            malt(s,"04_aligned", "03_filtered")  
+            entry["count"] += 1
+            entry["wall"] += metrics["wall"]
+            entry["maxwall"] = max(entry["maxwall"], metrics["wall"])
+            entry["cpu"] += metrics["cpu"]
+            entry["maxrss"] = max(entry["maxrss"], metrics["maxrss"])
+            entry["readbytes"] += metrics["readbytes"]
+            entry["writtenbytes"] += metrics["writtenbytes"]
+    columns = ["count", "wall", "maxwall", "cpu", "maxrss", "readbytes", "writtenbytes", "readsin", "readsout"]
+    lines = ["kind\tname\t"+"\t".join(columns)+"\n"]
+    for key in sorted(summary):
+        entry = summary[key]
+        lines.append(key[0]+"\t"+key[1]+"\t"+"\t".join(str(round(entry[c], 3)) for c in columns)+"\n")
+    with open(ownFile(".metrics.tsv"), 'w') as out:
+        out.writelines(lines)
+    loghandle.write("Resource usage of this run (seconds, bytes):\n")
+    loghandle.writelines(lines)
+
+
+#Checkpoint manifest of the stages of a sample ("" for the stages of the whole analysis) in the output directory
+#SQLite locking is unreliable on NFS, so in worker mode every sample has its own, only written by the worker holding the sample's lease
+def checkpointFile(sample):
+    if variables["workerid"] == "":
+        return variables["name"]+".checkpoints.sqlite"
+    if sample == "":
+        return "queue/"+variables["name"]+".checkpoints.sqlite"
+    return "queue/checkpoints/"+sample+".sqlite"
+
+
+#Open the checkpoint manifest of a sample
+def openCheckpoints(sample):
+    db = sqlite3.connect(checkpointFile(sample), timeout=600)
+    db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS stages (sample TEXT, stage TEXT, fingerprint TEXT, outputs TEXT, result TEXT, finished TEXT, PRIMARY KEY (sample, stage))")
+    return db
+
+
+#Content digest of a file, digests are kept in the manifest of the sample and only recomputed if size or modification time changed
+def fileDigest(path, sample):
+    info = os.stat(path)
+    db = openCheckpoints(sample)
+    try:
+        row = db.execute("SELECT digest FROM files WHERE path=? AND size=? AND mtime=?", (path, info.st_size, info.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        with db:
+            db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, info.st_size, info.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+    finally:
+        db.close()
+
+
+#Identity of the MALT database, based on the names, sizes and modification times of its files
+def databaseIdentity():
+    identity = hashlib.blake2b(digest_size=16)
+    for root, dirs, files in os.walk(variables["maltbase"]):
+        dirs.sort()
+        for f in sorted(files):
+            info = os.stat(os.path.join(root, f))
+            identity.update((os.path.join(root, f)+"\t"+str(info.st_size)+"\t"+str(info.st_mtime_ns)+"\n").encode())
+    return identity.hexdigest()
+
+
+#Fingerprint of a stage: the digests of its inputs and the configuration values it depends on
+#Digests of inputs that are in known (outputs of earlier stages recorded in the checkpoint manifest) are not computed again
+def stageFingerprint(sample, stage, inputs, known=None):
+    fingerprint = dict()
+    fingerprint["inputs"] = [known[i] if known is not None and i in known else fileDigest(i, sample) for i in inputs]
+    fingerprint["config"] = [str(variables[k]) for k in stagekeys[stage]]
+    if stage == "align":
+        fingerprint["database"] = databaseIdentity()
+    return hashlib.blake2b(json.dumps(fingerprint, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+#Check whether a stage's fingerprint is unchanged and its outputs are still intact, returns this, the stored result
+#and the outputs where they are kept now
+def stageCurrent(sample, stage, fingerprint):
+    if not variables["resume"]:
+        return False, None, None
+    db = openCheckpoints(sample)
+    try:
+        row = db.execute("SELECT fingerprint, outputs, result, finished FROM stages WHERE sample=? AND stage=?", (sample, stage)).fetchone()
+    finally:
+        db.close()
+    if row is None or row[0] != fingerprint:
+        return False, None, None
+    outputs = json.loads(row[1])
+    for path, digest in outputs.items():
+        if not(os.path.exists(path)) or fileDigest(path, sample) != digest:
+            return False, None, None
+    loghandle.write("Skipped "+stage+" for sample "+sample+", inputs and parameters are unchanged since "+row[3]+"\n")
+    return True, json.loads(row[2]), list(outputs)
+
+
+#Point the checkpoint of a stage to the places its outputs were moved or compressed to (moved maps the old paths to them)
+#The digests of the contents are kept for the new paths, so the stages reading the outputs stay current
+def moveCheckpoint(sample, stage, moved):
+    if len(moved) == 0:
+        return
+    db = openCheckpoints(sample)
+    try:
+        row = db.execute("SELECT outputs FROM stages WHERE sample=? AND stage=?", (sample, stage)).fetchone()
+        if row is None:
+            return
+        outputs = dict()
+        with db:
+            for path, digest in json.loads(row[0]).items():
+                if path in moved:
+                    path = moved[path]
+                    info = os.stat(path)
+                    db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, info.st_size, info.st_mtime_ns, digest))
+                outputs[path] = digest
+            db.execute("UPDATE stages SET outputs=? WHERE sample=? AND stage=?", (json.dumps(outputs), sample, stage))
+    finally:
+        db.close()
+
+
+#Record a finished stage in the checkpoint manifest
+def recordStage(sample, stage, fingerprint, outputs, result=None):
+    digests = dict((o, fileDigest(o, sample)) for o in outputs)
+    db = openCheckpoints(sample)
+    try:
+        with db:
+            db.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)", (sample, stage, fingerprint, json.dumps(digests), json.dumps(result), str(datetime.now())))
+    finally:
+        db.close()
+
+
+#Check whether all stages of a sample are still current from the checkpoint manifest alone, so a sample whose
+#intermediate files were deleted is not analysed again: the digests of the intermediate files are taken from the
+#records of the stages that wrote them, only the raw files and the final outputs have to be there.
+#The outputs are taken from where the records say they are kept, after moving or compressing them.
+def sampleCurrent(s, stages):
+    if not variables["resume"]:
+        return False
+    names = [stage for stage, rclass, deps in stages]
+    if not("align" in names):
+        names.append("align")
+    saved = dict(manifest[s])
+    known = dict()
+    db = openCheckpoints(s)
+    try:
+        for stage in names:
+            fingerprint = stageFingerprint(s, stage, stageSpec(s, stage)[0], known)
+            row = db.execute("SELECT fingerprint, outputs FROM stages WHERE sample=? AND stage=?", (s, stage)).fetchone()
+            if row is None or row[0] != fingerprint:
+                raise LookupError(stage)
+            outputs = json.loads(row[1])
+            known.update(outputs)
+            if len(outputs) > 0:
+                manifest[s][stage] = list(outputs)
+        for path in manifest[s]["align"]:
+            if not(os.path.exists(path)) or fileDigest(path, s) != known[path]:
+                raise LookupError("align")
+    except (LookupError, OSError):
+        manifest[s] = saved
+        return False
+    finally:
+        db.close()
+    return True
+
+
+#Run a stage of a sample unless the checkpoint manifest shows that it is still current
+#The outputs of the stage are added to the sample's manifest entry, from where they are kept if the stage is current
+def runStage(sample, stage, inputs, outputs, function, *args):
+    fingerprint = stageFingerprint(sample, stage, inputs)
+    current, result, kept = stageCurrent(sample, stage, fingerprint)
+    if current:
+        outputs = kept
+    else:
+        beginStage(sample, stage)
+        result = function(*args)
+        endStage()
+        recordStage(sample, stage, fingerprint, outputs, result)
+    if sample in manifest and len(outputs) > 0:
+        manifest[sample][stage] = outputs
+    return result
+
+
+#Stages of the analysis of a sample with their resource class and the stages they depend on
+#Alignment is only part of a sample's stages if samples are aligned one by one (maltbatch = 1)
+def sampleStages():
+    stages = list()
+    stages.append(("rawqc", "light", []))
+    stages.append(("trim", "cpu", ["rawqc"]))
+    stages.append(("trimqc", "light", ["trim"]))
+    stages.append(("filter", "cpu", ["trimqc"]))
+    if variables["dereplicate"]:
+        stages.append(("derep", "light", ["filter"]))
+    if variables["maltbatch"] == 1:
+        stages.append(("align", "memory", [alignAfter()]))
+    if variables["fastqcreports"]:
+        stages.append(("rawreport", "light", []))
+        stages.append(("trimreport", "light", ["trim"]))
+        stages.append(("filterreport", "light", ["filter"]))
+    return stages
+
+
+#Stage after which a sample is ready for alignment
+def alignAfter():
+    if variables["dereplicate"]:
+        return "derep"
+    return "filter"
+
+
+#Stage whose output files a stage reads, which can differ from the stage it waits for
+def stageInput(stage):
+    if stage == "align":
+        return alignAfter()
+    return dict(trimqc="trim", filter="trim", derep="filter", trimreport="trim", filterreport="filter").get(stage)
+
+
+#Scheduling priority of a stage, later stages go first so samples finish early, FastQC reports go last
+#Retiring intermediate files goes before all stages, it frees the scratch directory
+stagepriority = dict(rawqc=1, trim=2, trimqc=3, filter=4, derep=5, align=6, rawreport=0, trimreport=0, filterreport=0, retire=7)
+
+
+#Tokens a task of a resource class takes: cores, and MALT instances for the memory class
+def classTokens(rclass, threads=None):
+    tokens = dict(cpu=1, memory=0)
+    if rclass == "cpu":
+        tokens["cpu"] = variables["toolthreads"]
+    if rclass == "memory":
+        tokens["cpu"] = threads if threads is not None else variables["toolthreads"]
+        tokens["memory"] = 1
+    tokens["cpu"] = min(tokens["cpu"], variables["corebudget"])
+    return tokens
+
+
+#Stage directories of the analysis, single-end analyses have no merging
+#The directories of the intermediate stages are in the scratch directory if there is one
+def stageDirs():
+    if variables["paired"]:
+        dirs = dict(raw="00_RAW", trim="01_trimmed", merge="02_merged", filter="03_filtered", align="04_aligned")
+    else:
+        dirs = dict(raw="00_RAW", trim="01_trimmed", filter="02_filtered", align="03_aligned")
+    if variables["scratchdir"] != "":
+        for d in ["trim", "merge", "filter"]:
+            if d in dirs:
+                dirs[d] = variables["scratchdir"]+"/"+dirs[d]
+    return dirs
+
+
+#Resource class of retiring the intermediate files of a stage, compressing them takes a tool's cores
+def retireClass(stage):
+    if variables["retain"+stage] == "compress":
+        return "cpu"
+    return "light"
+
+
+#Place of a file in the output directory, for files in the scratch directory
+def promotedPath(path):
+    if variables["scratchdir"] != "" and path.startswith(variables["scratchdir"]+"/"):
+        return os.path.relpath(path, variables["scratchdir"])
+    return path
+
+
+#Scratch directory of this analysis (and worker), so analyses sharing the scratch space do not collide
+def scratchDir():
+    if variables["scratch"] == "":
+        return ""
+    name = variables["name"]+"-"+hashlib.blake2b(os.getcwd().encode(), digest_size=8).hexdigest()
+    if variables["workerid"] != "":
+        name += "-"+variables["workerid"]
+    return os.path.join(os.path.abspath(os.path.expanduser(variables["scratch"])), name)
+
+
+#Other files a stage may leave in its directory: the reads prinseq++ trimmed away (named after -out_bad, with .fastq
+#and the second read of a pair added) and the reads that were too short, files that were not written are skipped by retire
+def stageExtras(s, stage):
+    dirs = stageDirs()
+    if stage == "trim":
+        return [dirs["trim"]+"/"+s+".trim.bad"+suffix for suffix in ["", ".fastq", "_2.fastq"]]
+    if stage == "filter":
+        return [dirs["filter"]+"/bad_"+s+".filtered.bad.fastq"]
+    return []
+
+
+#Apply the retention policy to the intermediate files of a stage of a sample (its outputs are files) once no other stage
+#needs them, returns where the outputs of the stage are kept. The checkpoint of the stage follows moved and gzipped outputs,
+#zstd cannot be read by the tools, so like deleted outputs these are made again if a later stage needs them.
+def retire(s, stage, files):
+    policy = variables["retain"+stage]
+    beginStage(s, "retire")
+    kept = list()
+    moved = dict()
+    for path in files+stageExtras(s, stage):
+        if not os.path.exists(path):
+            continue
+        target = promotedPath(path)
+        if policy == "delete":
+            os.remove(path)
+            continue
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        if policy == "compress" and not(path.endswith(".gz") or path.endswith(".zst")):
+            target = compressFile(path, target)
+        elif target != path:
+            shutil.move(path, target)
+        if path in files:
+            kept.append(target)
+            if target != path and not(target.endswith(".zst")):
+                moved[path] = target
+    moveCheckpoint(s, stage, moved)
+    endStage()
+    return kept
+
+
+#Compress a file to target (with .zst or .gz added) and remove it, zstd is used if it is requested and installed
+def compressFile(infile, target):
+    zstd = shutil.which("zstd")
+    if variables["compression"] == "zstd" and zstd is not None:
+        command = startTool([zstd, '-q', '-f', '-'+str(variables["compresslevel"]), infile, '-o', target+".zst"])
+        target += ".zst"
+    else:
+        pigz = shutil.which(variables["pigz"])
+        gzipcommand = [pigz, '-p', str(max(1, variables["toolthreads"]))] if pigz is not None else [variables["gzip"]]
+        with open(target+".gz", 'wb') as out:
+            command = startTool(gzipcommand+['-'+str(variables["compresslevel"]), '-c', infile], stdout=out)
+        target += ".gz"
+    finishTool(command)
+    os.remove(infile)
+    return target
+
+
+#Remove the empty directories left in the scratch directory
+def clearScratch():
+    if variables["scratchdir"] == "" or not os.path.isdir(variables["scratchdir"]):
+        return
+    for root, dirs, files in os.walk(variables["scratchdir"], topdown=False):
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+
+
+#Output files of a stage of a sample
+def stageOutputs(s, stage):
+    dirs = stageDirs()
+    if stage == "trim":
+        if variables["paired"]:
+            return [dirs["trim"]+"/"+s+".trimmed"+variables["pairID1"]+"fastq", dirs["trim"]+"/"+s+".trimmed"+variables["pairID2"]+"fastq"]
+        return [dirs["trim"]+"/"+s+".trimmed.fastq"]
+    if stage == "filter":
+        return [dirs["filter"]+"/"+s+".filtered.good.fastq"]
+    if stage == "derep":
+        return [dirs["filter"]+"/"+s+".uniques.fasta", dirs["filter"]+"/"+s+".uniques.tsv"]
+    if stage == "align":
+        if variables["taxcache"] != "" and variables["dereplicate"]:
+            return [dirs["align"]+"/"+s+".assignments.tsv"]
+        return [dirs["align"]+"/"+s+".rma6", dirs["align"]+"/"+s+".assignments.tsv"]
+    return []
+
+
+#Inputs, outputs and the function (with its arguments) of a stage of a sample, inputs are taken from the manifest
+def stageSpec(s, stage):
+    dirs = stageDirs()
+    files = manifest[s]
+    outputs = stageOutputs(s, stage)
+    if stage == "rawqc":
+        return files["raw"], outputs, readQC, (s, dirs["raw"], "raw")
+    if stage == "rawreport":
+        return files["raw"], outputs, fastqc, (s, dirs["raw"], "raw")
+    if stage == "trim":
+        return files["raw"], outputs, trim, (s, dirs["trim"], dirs["raw"])
+    if stage == "trimqc":
+        return files["trim"], outputs, readQC, (s, dirs["trim"], "trimmed")
+    if stage == "trimreport":
+        return files["trim"], outputs, fastqc, (s, dirs["trim"], "trimmed")
+    if stage == "filter":
+        if variables["paired"]:
+            return files["trim"], outputs, filtering, (s, dirs["filter"], dirs["merge"])
+        return files["trim"], outputs, filtering, (s, dirs["filter"], dirs["trim"])
+    if stage == "filterreport":
+        return files["filter"], outputs, fastqc, (s, dirs["filter"], "filtered")
+    if stage == "derep":
+        return files["filter"], outputs, dereplicate, (s, dirs["filter"])
+    if stage == "align":
+        return alignInput(s), outputs, malt, (s, dirs["align"], dirs["filter"])
+    raise ValueError("Unknown stage "+stage)
+
+
+#run one stage of a sample in a pool worker with the sample's manifest entry, log lines are returned with the result
+#and the output files of the stage
+def runTask(s, stage, files):
+    global loghandle
+    loghandle = io.StringIO()
+    manifest[s] = files
+    try:
+        inputs, outputs, function, args = stageSpec(s, stage)
+        result = runStage(s, stage, inputs, outputs, function, *args)
+        return loghandle.getvalue(), True, result, manifest[s].get(stage)
+    except Exception as e:
+        loghandle.write(str(datetime.now())+": Stage "+stage+" for sample "+s+" failed: "+repr(e)+"\n")
+        return loghandle.getvalue(), False, None, None
+
+
+#align a batch of samples in a pool worker, returns the log lines and the aligned samples
+def runAlignBatch(samples, files):
+    global loghandle
+    loghandle = io.StringIO()
+    manifest.update(files)
+    dirs = stageDirs()
+    aligned = list()
+    try:
+        aligned = alignSamples(samples, dirs["align"], dirs["filter"])
+    except Exception as e:
+        loghandle.write(str(datetime.now())+": Alignment of "+", ".join(samples)+" failed: "+repr(e)+"\n")
+    return loghandle.getvalue(), aligned
+
+
+#retire the intermediate files of a stage of a sample in a pool worker, returns the log lines and where the outputs are kept
+def runRetire(s, stage, files):
+    global loghandle
+    loghandle = io.StringIO()
+    try:
+        kept = retire(s, stage, files)
+        return loghandle.getvalue(), True, kept
+    except Exception as e:
+        loghandle.write(str(datetime.now())+": Retiring the "+stage+" files of sample "+s+" failed: "+repr(e)+"\n")
+        return loghandle.getvalue(), False, None
+
+
+#set up the state of a pool worker process
+def initWorker(config, workdir):
+    variables.update(config)
+    os.chdir(workdir)
+
+
+#Check the breakpoint after a QC stage or the filtering and write the QC summary to the sample's log, returns False if the sample fails
+def checkBreakpoint(s, stage, results, log):
+    if stage == "rawqc":
+        t1 = results["rawqc"]
+        if int(t1[2])< variables["rawabsolute"]:
+            log.write("Breakpoint: Raw QC for sample "+s+" failed with a read count of only "+t1[2]+"\n")
+            return False
+        log.write("Raw QC for sample: "+s+" (based on R2)\n")
+        log.write("Minimal read length: "+t1[0]+", maximal read length: "+t1[1]+", number of reads: "+t1[2]+"\n")
+    if stage == "trimqc":
+        t1 = results["rawqc"]
+        t2 = results["trimqc"]
+        recordReads(s, "trim", t1[2], t2[2])
+        raw2trimloss = 1.0-(float(t2[2])/float(t1[2]))
+        if raw2trimloss > variables["raw2trimloss"]:
+            log.write("Breakpoint: Trimmed QC for sample "+s+" failed with a loss of "+str(raw2trimloss)+" compared to raw read counts\n")
+            return False
+        log.write("Trimmed QC for sample: "+s+" (based on R2) \n")
+        log.write("Minimal read length: "+t2[0]+", maximal read length: "+t2[1]+", number of reads: "+t2[2]+"\n")
+    if stage == "filter":
+        t1 = results["rawqc"]
+        t2 = results["trimqc"]
+        t3 = results["filter"]
+        recordReads(s, "filter", t2[2], t3[2])
+        if int(t3[2])< variables["filterabsolute"]:
+            log.write("Breakpoint: Filtered QC for sample "+s+" failed with a read count of only "+t3[2]+"\n")
+            return False
+        raw2filterloss = 1.0-(float(t3[2])/float(t1[2]))
+        if raw2filterloss > variables["raw2filterloss"]:
+            log.write("Breakpoint: Filtered QC for sample "+s+" failed with a loss of "+str(raw2filterloss)+" compared to raw read counts\n")
+            return False
+        trim2filterloss = 1.0-(float(t3[2])/float(t2[2]))
+        if trim2filterloss > variables["trim2filterloss"]:
+            log.write("Breakpoint: Filtered QC for sample "+s+" failed with a loss of "+str(trim2filterloss)+" compared to trimmed read counts\n")
+            return False
+        log.write("Filtered QC for sample: "+s+"\n")
+        log.write("Minimal read length: "+t3[0]+", maximal read length: "+t3[1]+", number of reads: "+t3[2]+"\n")
+    if stage == "derep":
+        reads, uniques = results["derep"]
+        recordReads(s, "derep", reads, uniques)
+    return True
+
+
+#Run the stages of all samples as a task graph in a process pool
+#Tasks start as soon as the stages they depend on are done and enough tokens of their resource class are free:
+#cores (the core budget) for every task and MALT instances (maltinstances) for alignments.
+#A failed breakpoint or stage prunes the stages of the sample that depend on it, the log of a sample is written as one block once it is done.
+#In watch mode source is called every watchinterval seconds for new samples until it reports that the input is finished.
+#Intermediate files are retired by tasks of their own (retire:<stage>) once no stage of the sample needs them.
+def schedule(samples, source=None):
+    capacity = dict(cpu=variables["corebudget"], memory=variables["maltinstances"])
+    free = dict(capacity)
+    pool = ProcessPoolExecutor(max_workers=capacity["cpu"], initializer=initWorker, initargs=(dict(variables), os.getcwd()))
+    stages = sampleStages()
+    order = dict()
+    waiting = dict()
+    finished = dict()
+    results = dict()
+    logs = dict()
+    active = dict()
+    #one queue of ready tasks per resource class, within a class all tasks need the same tokens
+    ready = dict(memory=list(), cpu=list(), light=list())
+    running = dict()
+    toalign = list()
+    #tasks in the ready queues or running and how many of them can still bring a sample to the alignment (all but FastQC reports),
+    #samples in running alignment batches, stages whose intermediate files were retired
+    queued = set()
+    feeding = [0]
+    aligning = set()
+    retired = dict()
+    abandoned = set()
+    retaining = [stage for stage in retainstages if variables["retain"+stage] != "keep" or variables["scratchdir"] != ""]
+
+    def addSample(s):
+        order[s] = len(order)
+        logs[s] = io.StringIO()
+        logs[s].write(str(datetime.now())+": Running analysis for sample "+s+"\n")
+        waiting[s] = dict((stage, (rclass, deps)) for stage, rclass, deps in stages)
+        finished[s] = set()
+        results[s] = dict()
+        active[s] = 0
+        retired[s] = set()
+        if sampleCurrent(s, stages):
+            logs[s].write("Skipped all stages of sample "+s+", inputs and parameters are unchanged\n")
+            waiting[s].clear()
+            sampleDone(s)
+            return
+        release(s)
+
+    #move the tasks of a sample whose dependencies are done to the ready queues
+    def release(s):
+        for stage in list(waiting[s]):
+            rclass, deps = waiting[s][stage]
+            if all(d in finished[s] for d in deps):
+                del waiting[s][stage]
+                heapq.heappush(ready[rclass], (-stagepriority[stage], order[s], s, stage))
+                queued.add((s, stage))
+                if not(stage.endswith("report")):
+                    feeding[0] += 1
+                active[s] += 1
+
+    #whether a stage of the sample that reads the outputs of a stage has yet to run
+    def needed(s, stage):
+        for other, rclass, deps in stages:
+            if stageInput(other) == stage and (other in waiting[s] or (s, other) in queued):
+                return True
+        return stage == alignAfter() and (s in toalign or s in aligning)
+
+    #queue the retirement of the intermediate files no stage of the sample needs anymore
+    def tidy(s):
+        for stage in retaining:
+            if stage in finished[s] and not(stage in retired[s]) and not(needed(s, stage)):
+                retired[s].add(stage)
+                heapq.heappush(ready[retireClass(stage)], (-stagepriority["retire"], order[s], s, "retire:"+stage))
+                active[s] += 1
+
+    #drop the waiting tasks of a sample that depend on a stage, directly or indirectly
+    def prune(s, stage):
+        dropped = set([stage])
+        changed = True
+        while changed:
+            changed = False
+            for other in list(waiting[s]):
+                if any(d in dropped for d in waiting[s][other][1]):
+                    dropped.add(other)
+                    del waiting[s][other]
+                    changed = True
+
+    #stop a sample whose lease another worker took over (worker mode), its tasks that did not start yet are dropped
+    def abandon(s):
+        abandoned.add(s)
+        waiting[s].clear()
+        if s in toalign:
+            toalign.remove(s)
+        for rclass in ready:
+            for priority, position, t, stage in ready[rclass]:
+                if t == s:
+                    active[s] -= 1
+                    if (s, stage) in queued:
+                        queued.discard((s, stage))
+                        if not(stage.endswith("report")):
+                            feeding[0] -= 1
+            ready[rclass] = [task for task in ready[rclass] if task[2] != s]
+            heapq.heapify(ready[rclass])
+        logs[s].write(str(datetime.now())+": Abandoned sample "+s+", another worker took over its lease\n")
+        if active[s] == 0:
+            sampleDone(s)
+
+    def fits(tokens):
+        return all(free[k] >= tokens[k] for k in tokens)
+
+    def take(tokens, sign):
+        for k in tokens:
+            free[k] -= sign*tokens[k]
+
+    def sampleDone(s):
+        loghandle.write(logs[s].getvalue())
+        loghandle.flush()
+        del logs[s]
+
+    #log lines of a task, samples aligned in batches may be done before their last files are retired
+    def sampleLog(s, log):
+        if s in logs:
+            logs[s].write(log)
         else:
-            fastqc(s, "00_RAW", "single")
-            t1 = readQC(s, "00_RAW", "raw")
-            if int(t1[2])< variables["rawabsolute"]:
-                loghandle.write("Breakpoint: Raw QC for sample "+s+" failed with a read count of only "+t1[2]+"\n")
+            loghandle.write(log)
+            loghandle.flush()
+
+    for s in samples:
+        addSample(s)
+    nextpoll = time.time()+variables["watchinterval"]
+    while True:
+        if source is not None and time.time() >= nextpoll:
+            new, over = source()
+            for s in new:
+                addSample(s)
+            if over:
+                source = None
+            nextpoll = time.time()+variables["watchinterval"]
+        for lease in list(lostleases):
+            s = os.path.basename(lease)[:-len(".lease")]
+            if s in logs and not(s in abandoned):
+                abandon(s)
+        #a batch of alignments starts when it is full (never with maltbatch = 0) or when no further sample can join it,
+        #if it only lacks cores no other task starts until it has them
+        size = variables["maltbatch"] if variables["maltbatch"] > 0 else len(toalign)+1
+        tokens = classTokens("memory", maltThreads())
+        due = len(toalign) > 0 and (len(toalign) >= size or feeding[0] == 0)
+        while due and fits(tokens):
+            batch = toalign[:size]
+            del toalign[:size]
+            take(tokens, 1)
+            aligning.update(batch)
+            running[pool.submit(runAlignBatch, batch, dict((b, manifest[b]) for b in batch))] = (batch, "batch", tokens)
+            due = len(toalign) > 0 and (len(toalign) >= size or feeding[0] == 0)
+        hold = due and free["memory"] >= tokens["memory"]
+        #likewise the first memory or cpu task that only lacks cores holds back the less urgent tasks of the classes after it,
+        #so one-core tasks do not take every core that becomes free
+        blocked = None
+        for rclass in ["memory", "cpu", "light"]:
+            tokens = classTokens(rclass)
+            while not(hold) and len(ready[rclass]) > 0 and fits(tokens) and (blocked is None or ready[rclass][0] < blocked):
+                priority, position, s, stage = heapq.heappop(ready[rclass])
+                take(tokens, 1)
+                if stage.startswith("retire:"):
+                    running[pool.submit(runRetire, s, stage[7:], manifest[s][stage[7:]])] = (s, stage, tokens)
+                else:
+                    running[pool.submit(runTask, s, stage, manifest[s])] = (s, stage, tokens)
+            if blocked is None and rclass != "light" and len(ready[rclass]) > 0 and not(fits(tokens)) and all(free[k] >= tokens[k] for k in tokens if k != "cpu"):
+                blocked = ready[rclass][0]
+        if len(running) == 0:
+            if source is None:
+                break
+            time.sleep(max(0.0, nextpoll-time.time()))
+            continue
+        done, notdone = wait(list(running), timeout=None if source is None else max(0.0, nextpoll-time.time()), return_when=FIRST_COMPLETED)
+        for future in done:
+            s, stage, tokens = running.pop(future)
+            take(tokens, -1)
+            if stage == "batch":
+                log, aligned = future.result()
+                for b in aligned:
+                    manifest[b]["align"] = stageOutputs(b, "align")
+                loghandle.write(log)
+                loghandle.flush()
+                aligning.difference_update(s)
+                for b in s:
+                    if not(b in abandoned):
+                        tidy(b)
                 continue
-            loghandle.write("Raw QC for sample: "+s+" (based on R2)\n")
-            loghandle.write("Minimal read length: "+t1[0]+", maximal read length: "+t1[1]+", number of reads: "+t1[2]+"\n")
-            trim(s, "01_trimmed", "00_RAW")
-            fastqc(s+".trimmed", "01_trimmed", "single")
-            t2 = readQC(s, "01_trimmed", "trimmed")
-            raw2trimloss = 1.0 - (float(t2[2])/float(t1[2]))
-            if raw2trimloss > variables["raw2trimloss"]:
-                loghandle.write("Breakpoint: Trimmed QC for sample "+s+" failed with a loss of "+str(raw2trimloss)+" compared to raw read counts\n")
+            if stage.startswith("retire:"):
+                log, ok, kept = future.result()
+                if ok:
+                    manifest[s][stage[7:]] = kept
+                sampleLog(s, log)
+                active[s] -= 1
+                if s in logs and active[s] == 0 and len(waiting[s]) == 0:
+                    sampleDone(s)
                 continue
-            loghandle.write("Trimmed QC for sample: "+s+" (based on R2) \n")
-            loghandle.write("Minimal read length: "+t2[0]+", maximal read length: "+t2[1]+", number of reads: "+t2[2]+"\n")
-            filtering(s, "02_filtered", "01_trimmed")
-            fastqc(s+".filtered", "02_filtered", "single")
-            t3 = readQC(s, "02_filtered", "filtered")
-            if int(t3[2])< variables["filterabsolute"]:
-                loghandle.write("Breakpoint: Filtered QC for sample "+s+" failed with a read count of only "+t3[2]+"\n")
+            log, ok, result, files = future.result()
+            logs[s].write(log)
+            active[s] -= 1
+            queued.discard((s, stage))
+            if not(stage.endswith("report")):
+                feeding[0] -= 1
+            if s in abandoned:
+                if active[s] == 0:
+                    sampleDone(s)
+                continue
+            if not ok:
+                #a failed FastQC report is only logged, otherwise the stages that need the failed one are dropped
+                if not(stage.endswith("report")):
+                    prune(s, stage)
+            else:
+                finished[s].add(stage)
+                results[s][stage] = result
+                if files is not None:
+                    manifest[s][stage] = files
+                if checkBreakpoint(s, stage, results[s], logs[s]):
+                    if stage == alignAfter() and variables["maltbatch"] != 1:
+                        toalign.append(s)
+                    if stage == "align":
+                        logs[s].write(str(datetime.now())+": Finished analysis for sample "+s+" successfully\n")
+                else:
+                    prune(s, stage)
+                release(s)
+            tidy(s)
+            if active[s] == 0 and len(waiting[s]) == 0:
+                sampleDone(s)
+    pool.shutdown()
+    clearScratch()
+    #workers share the manifest through the queue
+    if variables["workerid"] == "":
+        writeManifest()
+
+
+#Add up the assignments of the aligned samples into a sparse taxon x sample count matrix, one sample (column) at a time
+#The matrix is stored as compressed sparse columns in .npy files (data, indices, indptr) that can be memory-mapped,
+#with the row and column names in taxa.txt and samples.txt, only the taxon index and one column are held in memory
+def aggregate(samples, matrixdir):
+    loghandle.write(str(datetime.now())+": Started aggregation of "+str(len(samples))+" samples\n")
+    tempdir = matrixdir+".tmp"
+    if os.path.exists(tempdir):
+        shutil.rmtree(tempdir)
+    os.makedirs(tempdir)
+    taxmap = readTaxmap()
+    taxa = dict()
+    indptr = array('q', [0])
+    with open(tempdir+"/indices.raw", 'wb') as indices, open(tempdir+"/data.raw", 'wb') as data:
+        for s in samples:
+            counts = Counter()
+            with open(manifest[s]["align"][-1]) as assignments:
+                next(assignments)
+                for line in assignments:
+                    name, weight, hit, source = line.rstrip("\n").split("\t")
+                    counts["unassigned" if hit == "*" else taxmap.get(hit, hit)] += int(weight)
+            column = sorted((taxa.setdefault(taxon, len(taxa)), count) for taxon, count in counts.items())
+            littleEndian(array('i', [row for row, count in column])).tofile(indices)
+            littleEndian(array('q', [count for row, count in column])).tofile(data)
+            indptr.append(indptr[-1]+len(column))
+    writeNpy(tempdir+"/indices.npy", '<i4', indptr[-1], tempdir+"/indices.raw")
+    writeNpy(tempdir+"/data.npy", '<i8', indptr[-1], tempdir+"/data.raw")
+    with open(tempdir+"/indptr.raw", 'wb') as out:
+        littleEndian(indptr).tofile(out)
+    writeNpy(tempdir+"/indptr.npy", '<i8', len(indptr), tempdir+"/indptr.raw")
+    with open(tempdir+"/taxa.txt", 'w') as out:
+        out.writelines(taxon+"\n" for taxon in sorted(taxa, key=taxa.get))
+    with open(tempdir+"/samples.txt", 'w') as out:
+        out.writelines(s+"\n" for s in samples)
+    with open(tempdir+"/matrix.json", 'w') as out:
+        json.dump(dict(format="csc", shape=[len(taxa), len(samples)], nnz=indptr[-1]), out)
+    if os.path.exists(matrixdir):
+        shutil.rmtree(matrixdir)
+    os.replace(tempdir, matrixdir)
+    loghandle.write("Abundance matrix of "+str(len(taxa))+" taxa and "+str(len(samples))+" samples with "+str(indptr[-1])+" entries written to "+matrixdir+"\n")
+    loghandle.write(str(datetime.now())+": Finished aggregation successfully\n")
+
+
+#Reference to taxon table for the abundance matrix
+def readTaxmap():
+    taxmap = dict()
+    if variables["taxmap"] != "":
+        with open(variables["taxmap"]) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) >= 2:
+                    taxmap[fields[0]] = fields[1]
+    return taxmap
+
+
+#Values of an array in little-endian byte order, as the .npy files declare them
+def littleEndian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+#Turn a file of raw little-endian values into a one-dimensional .npy array (format version 1.0), without needing numpy
+def writeNpy(filename, dtype, count, rawfile):
+    header = "{'descr': '"+dtype+"', 'fortran_order': False, 'shape': ("+str(count)+",), }"
+    #the header is padded so that the data starts at a multiple of 64 bytes
+    header += " "*(63-(10+len(header)) % 64)+"\n"
+    with open(filename, 'wb') as out, open(rawfile, 'rb') as raw:
+        out.write(b"\x93NUMPY\x01\x00"+struct.pack('<H', len(header))+header.encode('latin1'))
+        shutil.copyfileobj(raw, out)
+    os.remove(rawfile)
+
+
+#Build the abundance matrix of the aligned samples, unless it is still current
+def aggregateSamples(samples):
+    aligned = [s for s in samples if "align" in manifest[s]]
+    if len(aligned) == 0:
+        return
+    matrixdir = variables["name"]+".matrix"
+    inputs = [manifest[s]["align"][-1] for s in aligned]
+    if variables["taxmap"] != "":
+        inputs.append(variables["taxmap"])
+    outputs = [matrixdir+"/"+f for f in ["data.npy", "indices.npy", "indptr.npy", "taxa.txt", "samples.txt", "matrix.json"]]
+    runStage("", "aggregate", inputs, outputs, aggregate, aligned, matrixdir)
+
+
+#Seconds between two looks at the queue and between two heartbeats
+def leasePoll():
+    return max(1.0, variables["leasetimeout"]/10)
+
+
+#Check whether a lease of another worker is stale: its modification time did not change for leasetimeout seconds
+#Only modification times are compared with each other, so the clocks of the hosts and the file server do not have to agree
+def leaseStale(lease, mtime):
+    now = time.time()
+    seen = leaseseen.get(lease)
+    if seen is None or seen[0] != mtime:
+        leaseseen[lease] = (mtime, now)
+        return False
+    return now-seen[1] > variables["leasetimeout"]
+
+
+#Take the lease <path>.lease by creating it exclusively, a stale lease of a dead worker is broken first, returns whether this worker holds it
+def takeLease(path):
+    lease = path+".lease"
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            mtime = os.stat(lease).st_mtime_ns
+            if not leaseStale(lease, mtime):
+                return False
+            #only one worker can rename the stale lease away
+            stale = lease+".stale."+variables["workerid"]
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return False
+        del leaseseen[lease]
+        if os.stat(stale).st_mtime_ns != mtime:
+            #another worker took the lease over in the meantime, give it back
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        with open(stale) as f:
+            owner = f.read().strip()
+        os.remove(stale)
+        loghandle.write(str(datetime.now())+": Took over the stale lease "+lease+" of worker "+owner+"\n")
+        return takeLease(path)
+    with os.fdopen(fd, 'w') as out:
+        out.write(variables["workerid"]+"\n")
+    leases.add(lease)
+    return True
+
+
+#Worker named in a lease file, None if there is no lease
+def leaseOwner(lease):
+    try:
+        with open(lease) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+#Check whether this worker still holds the lease <path>.lease
+def holdsLease(path):
+    lease = path+".lease"
+    return not(lease in lostleases) and leaseOwner(lease) == variables["workerid"]
+
+
+#Give up a lease of this worker, a lease another worker took over is left to it
+def releaseLease(path):
+    lease = path+".lease"
+    leases.discard(lease)
+    lostleases.discard(lease)
+    if leaseOwner(lease) != variables["workerid"]:
+        return
+    try:
+        os.remove(lease)
+    except FileNotFoundError:
+        pass
+
+
+#Renew the leases of this worker while it runs, a lease that is gone or names another worker was taken over and is lost
+def heartbeat():
+    while True:
+        time.sleep(leasePoll())
+        for lease in list(leases):
+            if leaseOwner(lease) != variables["workerid"]:
+                leases.discard(lease)
+                lostleases.add(lease)
                 continue
-            raw2filterloss = 1.0 - (float(t3[2])/float(t1[2]))
-            if raw2filterloss > variables["raw2filterloss"]:
-                loghandle.write("Breakpoint: Filtered QC for sample "+s+" failed with a loss of "+str(raw2filterloss)+" compared to raw read counts\n")
+            try:
+                os.utime(lease)
+            except FileNotFoundError:
+                pass
+
+
+#Claim up to count of the pending samples that are neither done nor leased by another worker
+#Samples that are done or claimed are removed from pending, so every claim only looks at the samples leased by other workers
+#and the ones it claims
+def claimSamples(pending, count):
+    claimed = list()
+    for s in list(pending):
+        if len(claimed) >= count:
+            break
+        if os.path.exists("queue/"+s+".done"):
+            pending.remove(s)
+            continue
+        if takeLease("queue/"+s):
+            pending.remove(s)
+            #the sample may have been finished by the worker whose lease just ended
+            if os.path.exists("queue/"+s+".done"):
+                releaseLease("queue/"+s)
                 continue
-            trim2filterloss = 1.0 - (float(t3[2])/float(t2[2]))
-            if trim2filterloss > variables["trim2filterloss"]:
-                loghandle.write("Breakpoint: Filtered QC for sample "+s+" failed with a loss of "+str(trim2filterloss)+" compared to trimmed read counts\n")
+            claimed.append(s)
+    return claimed
+
+
+#Samples a worker claims at once, they run in one schedule so their alignments are batched like in a single process
+def claimSize():
+    if variables["workerclaim"] > 0:
+        size = variables["workerclaim"]
+    elif variables["maltbatch"] > 0:
+        size = variables["maltbatch"]
+    else:
+        size = 10*variables["jobs"]
+    return max(1, size, variables["jobs"])
+
+
+#Work through the shared queue: claim claimSize() samples at a time, run all their stages and mark them as done,
+#until every sample of the analysis is done. Samples whose lease another worker took over are abandoned without being marked. The worker that sees the last sample done writes the complete manifest.
+def workQueue(samples):
+    pending = list(samples)
+    while True:
+        claimed = claimSamples(pending, claimSize())
+        if len(claimed) == 0:
+            if len(pending) == 0:
+                break
+            time.sleep(leasePoll())
+            continue
+        loghandle.write(str(datetime.now())+": Worker "+variables["workerid"]+" claimed "+", ".join(claimed)+"\n")
+        loghandle.flush()
+        schedule(claimed)
+        for s in claimed:
+            if not holdsLease("queue/"+s):
+                #another worker took the sample over, it is left to that worker and waited for like the other leased samples
+                lostleases.discard("queue/"+s+".lease")
+                pending.append(s)
+                loghandle.write(str(datetime.now())+": Worker "+variables["workerid"]+" lost the lease of sample "+s+" and abandoned it\n")
+                loghandle.flush()
                 continue
-            loghandle.write("Filtered QC for sample: "+s+"\n")
-            loghandle.write("Minimal read length: "+t3[0]+", maximal read length: "+t3[1]+", number of reads: "+t3[2]+"\n")
-            malt(s,"03_aligned", "02_filtered") 
-            
-        loghandle.write(str(datetime.now())+": Finished analysis for sample "+s+" successfully\n")
-    loghandle.write("ALL DONE!")
+            with open("queue/"+s+".done.tmp."+variables["workerid"], 'w') as out:
+                json.dump(manifest[s], out)
+            os.replace("queue/"+s+".done.tmp."+variables["workerid"], "queue/"+s+".done")
+            releaseLease("queue/"+s)
+    for s in samples:
+        with open("queue/"+s+".done") as f:
+            manifest[s] = json.load(f)
+    with open(variables["name"]+".manifest.json.tmp."+variables["workerid"], 'w') as out:
+        json.dump(manifest, out, indent=1, sort_keys=True)
+    os.replace(variables["name"]+".manifest.json.tmp."+variables["workerid"], variables["name"]+".manifest.json")
+    #one of the workers that are done builds the abundance matrix
+    if takeLease("queue/aggregate"):
+        aggregateSamples(samples)
+        releaseLease("queue/aggregate")
+
+
+#run the full analysis pipeline  
+def runAnalysis(indir, outdir, config, jobs=None, threads=None, restart=False, watch=False, worker=False):
+    readConfig(config)
+    if restart:
+        variables["resume"] = False
+    if watch:
+        variables["watch"] = True
+    if worker:
+        variables["workerid"] = socket.gethostname()+"-"+str(os.getpid())
+        #samples are taken from the queue, new input files are not watched
+        variables["watch"] = False
+    variables["runid"] = str(datetime.now())
+    if worker:
+        variables["runid"] += " "+variables["workerid"]
+    if jobs is not None:
+        variables["jobs"] = jobs
+    if threads is not None:
+        variables["threads"] = threads
+    setThreadBudget()
+    indir = os.path.abspath(indir)
+    samples = setupFiles(indir, outdir)
+    variables["scratchdir"] = scratchDir()
+    printSamples(samples)
+    loghandle.write("Configuration for this analysis is read from: "+str(config)+"\n")
+    loghandle.write("Core budget of "+str(variables["corebudget"])+", "+str(variables["toolthreads"])+" thread(s) per tool, "+str(variables["maltinstances"])+" MALT instance(s) at once\n")
+    if variables["workerid"] != "" and variables["taxcache"] != "" and not(variables["taxcacheworkers"]):
+        loghandle.write("Workers do not use the sequence cache "+variables["taxcache"]+", set taxcacheworkers = True if it is on a filesystem with working locks\n")
+        variables["taxcache"] = ""
+    loghandle.flush()
+    if variables["workerid"] != "":
+        workQueue(samples)
+    elif variables["watch"]:
+        loghandle.write(str(datetime.now())+": Watching "+indir+" for new samples\n")
+        loghandle.flush()
+        #samples excluded by the triage are known as well, they are not picked up again
+        schedule(samples, watchInput(indir, set(s for s in manifest if not(None in manifest[s]["raw"]))))
+    else:
+        schedule(samples)
+    if variables["workerid"] == "":
+        #including the samples found in watch mode
+        aggregateSamples(list(manifest))
+    summariseMetrics()
+    loghandle.write("ALL DONE!\n")
         
     loghandle.close()
 
@@ -451,6 +2370,12 @@ if __name__ == '__main__':
     parser.add_argument("indirectory", type=str, help='''Input directory''')
     parser.add_argument("outdirectory", type=str, help='''Output directory''')
     parser.add_argument("config", type=str, help='''Configuration file''')
+    parser.add_argument("-j", "--jobs", type=int, default=None, help='''Number of CPU-bound tools to run at once (overrides "jobs" in the configuration file)''')
+    parser.add_argument("-t", "--threads", type=int, default=None, help='''Total number of cores shared by all running tools, 0 for all usable cores (overrides "threads" in the configuration file)''')
+
+    parser.add_argument("--watch", action="store_true", help='''Keep watching the input directory and analyse every sample as soon as its read files are complete''')
+    parser.add_argument("--worker", action="store_true", help='''Run as one of several workers sharing the samples of the output directory, on one or more hosts''')
+    parser.add_argument("--restart", action="store_true", help='''Run all stages again, even if the checkpoints of an earlier run are still current''')
 
     args = parser.parse_args()
-    runAnalysis(args.indirectory, args.outdirectory, args.config)
+    runAnalysis(args.indirectory, args.outdirectory, args.config, args.jobs, args.threads, args.restart, args.watch, args.worker)
@@ -0,0 +1,89 @@
+'''
+Synthetic amplicon read sets for the STARA benchmark
+
+Every sample draws its reads from a shared pool of template amplicons with skewed abundances, so the reads are as redundant
+as real 16S amplicon data. Paired samples are written as <sample>.1.fastq.gz and <sample>.2.fastq.gz (the default pairIDs),
+single-end samples as <sample>.fastq.gz. Qualities drop towards the 3' end, so quality trimming has something to do.
+'''
+import argparse
+import gzip
+import os
+import random
+
+
+complement = str.maketrans("ACGT", "TGCA")
+
+
+#Template amplicons of the given length
+def makeTemplates(count, length, rng):
+    return ["".join(rng.choice("ACGT") for i in range(length)) for t in range(count)]
+
+
+#Quality string of a read: high quality, the last tail bases lower
+def makeQuality(length, tail):
+    return "I"*(length-tail)+"5"*tail
+
+
+#Copy of a sequence with substitution errors
+def mutate(seq, errors, rng):
+    if errors == 0:
+        return seq
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() < errors:
+            seq[i] = rng.choice("ACGT")
+    return "".join(seq)
+
+
+#Write the read files of one sample, returns their names
+def writeSample(outdir, name, templates, weights, reads, readlength, paired, errors, rng):
+    chosen = rng.choices(range(len(templates)), weights=weights, k=reads)
+    quality = makeQuality(readlength, 20)
+    if paired:
+        files = [outdir+"/"+name+".1.fastq.gz", outdir+"/"+name+".2.fastq.gz"]
+    else:
+        files = [outdir+"/"+name+".fastq.gz"]
+    handles = [gzip.open(f, 'wt', compresslevel=1) for f in files]
+    for n, t in enumerate(chosen):
+        template = templates[t]
+        header = "@"+name+":"+str(n)+":"+str(t)
+        handles[0].write(header+" 1:N:0\n"+mutate(template[:readlength], errors, rng)+"\n+\n"+quality+"\n")
+        if paired:
+            mate = template[-readlength:].translate(complement)[::-1]
+            handles[1].write(header+" 2:N:0\n"+mutate(mate, errors, rng)+"\n+\n"+quality+"\n")
+    for h in handles:
+        h.close()
+    return files
+
+
+#Write a synthetic read set of samples into outdir, returns the sample names
+def generate(outdir, samples, reads, paired=True, templates=500, length=460, readlength=250, errors=0.001, seed=1):
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    pool = makeTemplates(templates, length, rng)
+    #few abundant and many rare templates, as in a typical community
+    weights = [1.0/(i+1) for i in range(templates)]
+    names = list()
+    for i in range(samples):
+        name = "S"+str(i+1).zfill(len(str(samples)))
+        rng.shuffle(weights)
+        writeSample(outdir, name, pool, weights, reads, readlength, paired, errors, rng)
+        names.append(name)
+    return names
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Generate synthetic gzipped 16S amplicon reads for the STARA benchmark")
+    parser.add_argument("outdirectory", type=str, help='''Output directory''')
+    parser.add_argument("-n", "--samples", type=int, default=10, help='''Number of samples''')
+    parser.add_argument("-r", "--reads", type=int, default=2000, help='''Reads (pairs) per sample''')
+    parser.add_argument("--single", action="store_true", help='''Write single-end instead of paired reads''')
+    parser.add_argument("--templates", type=int, default=500, help='''Number of distinct amplicons''')
+    parser.add_argument("--length", type=int, default=460, help='''Amplicon length''')
+    parser.add_argument("--readlength", type=int, default=250, help='''Read length''')
+    parser.add_argument("--errors", type=float, default=0.001, help='''Substitution error rate per base''')
+    parser.add_argument("--seed", type=int, default=1, help='''Random seed''')
+
+    args = parser.parse_args()
+    generate(args.outdirectory, args.samples, args.reads, not args.single, args.templates, args.length, args.readlength, args.errors, args.seed)
@@ -0,0 +1,121 @@
+'''
+Benchmark of STARA's orchestration with synthetic reads and stand-in tools
+
+For every sample count a synthetic read set is generated (once, it is reused by later benchmarks), STARA is pointed at the
+stand-ins in benchmark/stubs through its configuration file and runAnalysis is timed end to end in a fresh process.
+The stage times come from the <name>.metrics.jsonl STARA writes. Results are printed and appended to a TSV file.
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import generate
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+stara = os.path.join(os.path.dirname(benchdir), "STARA", "Stara.py")
+stubdir = os.path.join(benchdir, "stubs")
+
+
+#Configuration file for a benchmark run: stand-in tools, a dummy MALT database and breakpoints the synthetic reads pass
+def writeConfig(workdir, paired, reads, extra):
+    os.makedirs(workdir+"/db", exist_ok=True)
+    with open(workdir+"/db/index.idx", 'w') as db:
+        db.write("stand-in MALT index\n")
+    config = dict()
+    config["FASTQC"] = stubdir+"/fastqc"
+    config["prinseq"] = stubdir+"/prinseq++"
+    config["flash"] = stubdir+"/flash"
+    config["maltrun"] = stubdir+"/malt-run"
+    config["maltbase"] = workdir+"/db"
+    config["paired"] = str(paired)
+    config["rawabsolute"] = str(max(1, reads//2))
+    config["filterabsolute"] = str(max(1, reads//4))
+    config["resume"] = "False"
+    config.update(extra)
+    with open(workdir+"/benchmark.conf", 'w') as out:
+        out.write("#STARA benchmark configuration\n")
+        for key in config:
+            out.write(key+" = "+config[key]+"\n")
+    return workdir+"/benchmark.conf"
+
+
+#Time one run of runAnalysis in a fresh interpreter, returns the wall time
+def timeRun(indir, outdir, config, jobs, threads):
+    code = "import sys, time; sys.path.insert(0, %r); import Stara; start = time.time(); Stara.runAnalysis(%r, %r, %r, %r, %r); print(time.time()-start)" % (os.path.dirname(stara), indir, outdir, config, jobs, threads)
+    result = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+#Sum of the wall times and the number of runs of every stage in a metrics file
+def stageTimes(metricsfile):
+    wall = Counter()
+    count = Counter()
+    with open(metricsfile) as f:
+        for line in f:
+            metrics = json.loads(line)
+            if metrics["kind"] == "stage":
+                wall[metrics["stage"]] += metrics["wall"]
+                count[metrics["stage"]] += 1
+    return wall, count
+
+
+#Stages in the order STARA runs them, the columns of the result file
+stages = ["setup", "rawqc", "trim", "trimqc", "filter", "derep", "align", "aggregate", "rawreport", "trimreport", "filterreport"]
+
+
+#Run the benchmark for every sample count, returns one row of results per sample count
+def benchmark(sizes, reads, paired, jobs, threads, workdir, extra, keep, outfile):
+    rows = list()
+    for size in sizes:
+        indir = workdir+"/input_"+("paired" if paired else "single")+"_"+str(size)+"_"+str(reads)
+        if not os.path.exists(indir+"/.complete"):
+            generate.generate(indir, size, reads, paired)
+            open(indir+"/.complete", 'w').close()
+        outdir = workdir+"/output_"+str(size)
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        config = writeConfig(workdir, paired, reads, extra)
+        wall = timeRun(indir, outdir, config, jobs, threads)
+        totals, counts = stageTimes(outdir+"/STARA.metrics.jsonl")
+        row = dict(samples=size, reads=size*reads, wall=round(wall, 3), samplespersec=round(size/wall, 3), readspersec=round(size*reads/wall, 1))
+        for stage in totals:
+            row[stage] = round(totals[stage], 3)
+        rows.append(row)
+        print("%d samples: %.1f s, %.2f samples/s, %.0f reads/s" % (size, wall, size/wall, size*reads/wall))
+        for stage in stages:
+            if stage in totals:
+                print("  %-12s %6d x  %10.3f s total  %8.4f s mean" % (stage, counts[stage], totals[stage], totals[stage]/counts[stage]))
+        if not keep:
+            shutil.rmtree(outdir)
+    columns = ["samples", "reads", "wall", "samplespersec", "readspersec"]+stages
+    header = not os.path.exists(outfile)
+    with open(outfile, 'a') as out:
+        if header:
+            out.write("date\tmode\tjobs\tthreads\t"+"\t".join(columns)+"\n")
+        for row in rows:
+            out.write(time.strftime("%Y-%m-%d %H:%M:%S")+"\t"+("paired" if paired else "single")+"\t"+str(jobs or "config")+"\t"+str(threads or "config")+"\t"+"\t".join(str(row.get(c, "")) for c in columns)+"\n")
+    return rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Benchmark STARA with synthetic reads and stand-in tools")
+    parser.add_argument("-s", "--sizes", type=str, default="10,100,1000,10000", help='''Comma-separated sample counts''')
+    parser.add_argument("-r", "--reads", type=int, default=1000, help='''Reads (pairs) per sample''')
+    parser.add_argument("--single", action="store_true", help='''Benchmark single-end instead of paired reads''')
+    parser.add_argument("-j", "--jobs", type=int, default=None, help='''Passed to runAnalysis''')
+    parser.add_argument("-t", "--threads", type=int, default=None, help='''Passed to runAnalysis''')
+    parser.add_argument("-w", "--workdir", type=str, default="bench_work", help='''Directory for the synthetic reads and the outputs''')
+    parser.add_argument("-c", "--config", type=str, action="append", default=[], help='''Extra configuration value as key=value, may be repeated''')
+    parser.add_argument("--keep", action="store_true", help='''Keep the STARA output directories''')
+    parser.add_argument("-o", "--output", type=str, default="benchmark.tsv", help='''TSV file the results are appended to''')
+
+    args = parser.parse_args()
+    extra = dict(c.split("=", 1) for c in args.config)
+    sizes = [int(s) for s in args.sizes.split(",")]
+    benchmark(sizes, args.reads, not args.single, args.jobs, args.threads, os.path.abspath(args.workdir), extra, args.keep, os.path.abspath(args.output))
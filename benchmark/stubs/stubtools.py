@@ -0,0 +1,63 @@
+'''
+Shared helpers of the stand-in tools used by the STARA benchmark
+
+The stand-ins accept the command lines STARA builds and write their output files with the names and layout
+of the real tools, but they only do the minimum of work needed to produce plausible reads.
+'''
+import gzip
+import io
+
+
+#Open a plain or gzipped read file as text, the file is opened only once so that pipes (/dev/fd/N) can be read as well
+def openReads(path, mode="rt"):
+    handle = open(path, 'rb')
+    if handle.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.open(handle, mode)
+    if 'b' in mode:
+        return handle
+    return io.TextIOWrapper(handle)
+
+
+#Records of a fastq file as (header, sequence, quality)
+def fastqRecords(path):
+    with openReads(path) as f:
+        while True:
+            header = f.readline()
+            if not header:
+                return
+            seq = f.readline().rstrip("\n")
+            f.readline()
+            qual = f.readline().rstrip("\n")
+            yield header.rstrip("\n"), seq, qual
+
+
+#Records of a fasta file as (header, sequence), sequences are on one line as STARA writes them
+def fastaRecords(path):
+    with openReads(path) as f:
+        for header in f:
+            yield header.rstrip("\n"), f.readline().rstrip("\n")
+
+
+#Parse "-option value" pairs, options listed in flags take no value, everything else is a positional argument
+def parseArgs(args, flags=()):
+    options = dict()
+    positional = list()
+    i = 0
+    while i < len(args):
+        if args[i] in flags:
+            options[args[i]] = True
+            i += 1
+        elif args[i].startswith("-") and i+1 < len(args):
+            options[args[i]] = args[i+1]
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return options, positional
+
+
+complement = str.maketrans("ACGTN", "TGCAN")
+
+
+def reverseComplement(seq):
+    return seq.translate(complement)[::-1]